@@ -0,0 +1,97 @@
+"""
+Micro-benchmark of landing page parsing, compares how pages used to be parsed (whole page
+built with html.parser, release date & links split out of the html) against
+_parse_landing_page, which only builds the main section (and uses lxml if it is installed)
+Checks both give the same release date & links, then times them
+Runs against real landing pages saved in benchmarks/fixtures, save them first with --save,
+or --save-fixtures to save the pages of fixture_datasets from landing_pages.json
+tests/test_landing_page_parsing.py checks both parsers agree on every saved page
+
+python benchmarks/landing_page_parsing.py --save-fixtures
+python benchmarks/landing_page_parsing.py --save <landing page url> <fixture name>
+python benchmarks/landing_page_parsing.py
+"""
+import os, sys, glob, json, timeit
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "clients"))
+
+from bs4 import BeautifulSoup
+from source_data_client import _parse_landing_page, html_parser
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+landing_pages_json = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "supporting_files", "landing_pages.json")
+# a single edition page, weekly deaths (two editions are downloaded) & ashe (matched on provisional/revised)
+fixture_datasets = ["construction", "weekly-deaths", "ashe-tables-3", "ashe-table-5"]
+repeats = 5
+number = 20
+
+def split_parse(content):
+    # exactly how SourceData parsed pages before _parse_landing_page
+    results = BeautifulSoup(content, "html.parser").find(id="main")
+    elements = results.find_all("li", class_="col col--md-12 col--lg-15 meta__item")
+    element = str(elements[1])
+    release_date = element.split(">")[-3].split("<")[0]
+
+    links = []
+    for element in results.find_all("div", class_="inline-block--md margin-bottom-sm--1"):
+        links.append(str(element).split("href=")[-1].split(">")[0].strip('"'))
+
+    return {'release_date': release_date, 'links': links}
+
+def targeted_parse(content):
+    # _parse_landing_page, reduced to what split_parse returns
+    page_details = _parse_landing_page(content)
+    return {'release_date': page_details['release_date'], 'links': [link['href'] for link in page_details['links']]}
+
+def time_parser(parser, content):
+    # best of repeats, in milliseconds per page
+    return min(timeit.repeat(lambda: parser(content), repeat=repeats, number=number)) / number * 1000
+
+def save_fixture(url, name):
+    # saves a landing page to use as a fixture
+    from http_session import get_session
+    r = get_session().get(url, headers={"User-Agent": "cmd-run-transforms/Version1.0.0 ONS cmd@ons.gov.uk"})
+    if r.status_code != 200:
+        raise Exception(f"{url} returned a {r.status_code} error")
+    os.makedirs(fixtures_dir, exist_ok=True)
+    with open(os.path.join(fixtures_dir, f"{name}.html"), "wb") as f:
+        f.write(r.content)
+    print(f"saved {url} as {name}.html")
+
+def save_fixtures():
+    # saves the landing pages of fixture_datasets
+    with open(landing_pages_json) as f:
+        page_details = json.load(f)
+    page_details.update(page_details.pop("ashe"))
+    for dataset in fixture_datasets:
+        for page_number, page in enumerate(page_details[dataset]["pages"]):
+            save_fixture(f"https://www.ons.gov.uk{page}", f"{dataset}-{page_number}")
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--save":
+        save_fixture(sys.argv[2], sys.argv[3])
+        return
+
+    if len(sys.argv) == 2 and sys.argv[1] == "--save-fixtures":
+        save_fixtures()
+        return
+
+    fixtures = sorted(glob.glob(os.path.join(fixtures_dir, "*.html")))
+    if not fixtures:
+        print(f"no landing pages saved in {fixtures_dir}, save some with --save <landing page url> <fixture name>")
+        return
+
+    print(f"_parse_landing_page is using {html_parser}")
+    for fixture in fixtures:
+        with open(fixture, "rb") as f:
+            content = f.read()
+
+        old, new = split_parse(content), targeted_parse(content)
+        assert old == new, f"parsers do not agree on {fixture} - {old} != {new}"
+
+        split = time_parser(split_parse, content)
+        targeted = time_parser(targeted_parse, content)
+        print(f"{os.path.basename(fixture)} ({len(content) / 1024:.0f} KB) - split {split:.2f} ms, main only {targeted:.2f} ms ({split / targeted:.1f}x)")
+
+if __name__ == "__main__":
+    main()
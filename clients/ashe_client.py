@@ -1,8 +1,12 @@
-import requests, os, glob, sys, json, zipfile
-from bs4 import BeautifulSoup
+import os, glob, json
 import pandas as pd
 
-from get_platform import verify
+from source_loader import SourceLoader
+from v4_sidecar import read_v4
+from http_cache import HttpCache
+from source_data_client import download_file, download_and_extract, get_landing_page
+from concurrent.futures import ThreadPoolExecutor
+from transform_client import get_module_sources, transform_module, fetch_transform_sources
 
 TRANSFORM_URL = "https://raw.github.com/ONS-OpenData/cmd-transforms/master"
 
@@ -42,7 +46,6 @@ class AsheCombiner:
         self.dataset = dataset
         self.edition = "time-series" # only combining time series editions
         self.v4 = v4
-        self.combiner_script = "latest_version.py"
 
         acceptable_datasets = [
             "ashe-tables-3", "ashe-table-5", "ashe-tables-9-and-10", "ashe-tables-11-and-12", 
@@ -56,44 +59,38 @@ class AsheCombiner:
         if "year_of_data" in kwargs.keys():
             self.year_of_data = kwargs["year_of_data"]
 
+        if "offline" in kwargs.keys():
+            self.cache = HttpCache("transforms", offline=kwargs["offline"])
+        else:
+            self.cache = HttpCache("transforms")
+
         print(f"Running AsheCombiner on {self.dataset}")
         self.run_combiner()
 
     def run_combiner(self):
-        self._write_latest_version_script()
+        self._get_latest_version_script()
         self._get_latest_version()
-        self._del_latest_version_script()
         self._combine_data()
 
-    def _write_latest_version_script(self):
+    def _get_latest_version_script(self):
         # getting the script
-        module_url = f"{TRANSFORM_URL}/modules/latest-version/module.py"
-        module_r = requests.get(module_url, verify=verify)
-        if module_r.status_code != 200:
-            raise Exception(f"{module_url} raised a {module_r.status_code} error")
-        
-        # writing the script
-        module_script = module_r.text
-        with open(self.combiner_script, "w") as f:
-            f.write(module_script)
-            f.close()
-            print(f"Ashe combiner script wrote as {self.combiner_script}")
+        self.module_url = f"{TRANSFORM_URL}/modules/latest-version/module.py"
+        module_r = self.cache.get(self.module_url)
+        if module_r['status_code'] != 200:
+            raise Exception(f"{self.module_url} raised a {module_r['status_code']} error")
+        self.module_script = module_r['content'].decode("utf-8")
         return
-    
-    def _del_latest_version_script(self):
-        # deletes the written transform and requirements scripts
-        os.remove(self.combiner_script)
-        print(f"Ashe combiner script removed - {self.combiner_script}")
 
     def _get_latest_version(self):
-        from latest_version import get_latest_version
-        self.downloaded_df = get_latest_version(self.dataset, self.edition)
+        # imports the script from memory
+        with SourceLoader({"latest_version": (self.module_script, self.module_url)}) as loader:
+            get_latest_version = loader.import_module("latest_version").get_latest_version
+            self.downloaded_df = get_latest_version(self.dataset, self.edition)
         self.downloaded_df = self.downloaded_df.rename(columns={'V4_2': 'v4_2'})
-        del sys.modules['latest_version']
         return 
     
     def _combine_data(self):
-        df = pd.read_csv(self.v4, dtype=str)
+        df = read_v4(self.v4) # from the parquet sidecar if there is one
         try:
             self.year_of_data
         except:
@@ -125,71 +122,36 @@ class AsheTransform:
         
         self.transform_url = f"{TRANSFORM_URL}/ashe/{self.dataset}/main.py"
         self.requirements_url = f"{TRANSFORM_URL}/ashe/{self.dataset}/requirements.txt"
-        self.transform_script = "temp_transform_script.py"
-        self.requirements_dict = {} # will be empty if no requirements needed
+        self.requirements_dict = {} # will be empty if no requirements needed, module -> (script, origin)
 
         self.year_of_data = kwargs['year_of_data']
 
+        if 'offline' in kwargs.keys():
+            self.cache = HttpCache("transforms", offline=kwargs['offline'])
+        else:
+            self.cache = HttpCache("transforms")
+
         #########
         # to be used if running locally
         self.path_to_local_transforms = ".."
         self.transform_location = f"{self.path_to_local_transforms}/cmd-transforms/ashe/{self.dataset}/main.py"
         self.requirements_location = f"{self.path_to_local_transforms}/cmd-transforms/ashe/{self.dataset}/requirements.txt"
         
-    def _write_transform(self):
-        # getting transform script
-        r = requests.get(self.transform_url, verify=verify)
-        if r.status_code == 404:
-            raise Exception(f"{self.transform_url} raised a 404 error, does the transform exist for '{self.dataset}' on github")
-        elif r.status_code != 200:
-            raise Exception(f"{self.transform_url} raised a {r.status_code} error")
-        
-        # writing transform script
-        script = r.text
-        with open(self.transform_script, "w") as f:
-            f.write(script)
-            f.close()
-            print(f"transform script wrote as {self.transform_script}")
-        
-        # getting any requirements
-        r = requests.get(self.requirements_url, verify=verify)
-        if r.status_code == 200:
-            requirements = r.text
-            requirements = requirements.strip().split("\n")
-    
-            for module in requirements:
-                module_url = f"{TRANSFORM_URL}/modules/{module}/module.py"
-                module_r = requests.get(module_url, verify=verify)
-                if module_r.status_code != 200:
-                    raise Exception(f"{module_url} raised a {module_r.status_code} error")
-    
-                module_script = module_r.text
-                self.requirements_dict[module] = module_script
-               
-        # writing any requirements
-        if self.requirements_dict: # if requirements not empty
-            for module in self.requirements_dict:
-                file_name = f"{module}.py".replace("-", "_")
-                file_name = f"{file_name}"
-                module_script = self.requirements_dict[module]
-                with open(file_name, "w") as f:
-                    f.write(module_script)
-                    f.close()
-                print(f"module script wrote as {file_name}")
+    def _get_transform(self):
+        # getting transform script and any requirements
+        self.transform_source, self.requirements_dict = fetch_transform_sources(
+            self.cache, self.dataset, self.transform_url, self.requirements_url, f"{TRANSFORM_URL}/modules"
+            )
+        self.transform_origin = self.transform_url
 
-    def _write_transform_local(self):
+    def _get_transform_local(self):
         # used for running local transforms
         # getting transform script
         print("Running local transform")
         with open(self.transform_location, "r") as f: 
-            script = f.read()
+            self.transform_source = f.read()
             f.close()
-        
-        # writing transform script
-        with open(self.transform_script, "w") as f:
-            f.write(script)
-            f.close()
-            print(f"transform script wrote as {self.transform_script}")
+        self.transform_origin = self.transform_location
 
         # getting any requirements
         if os.path.exists(self.requirements_location):
@@ -205,71 +167,33 @@ class AsheTransform:
             with open(module_location, "r") as f:
                 module_script = f.read()
                 f.close()
-            self.requirements_dict[module] = module_script
-            
-        # writing any requirements
-        if self.requirements_dict: # if requirements not empty
-            for module in self.requirements_dict:
-                file_name = f"{module}.py".replace("-", "_")
-                file_name = f"{file_name}"
-                module_script = self.requirements_dict[module]
-                with open(file_name, "w") as f:
-                    f.write(module_script)
-                    f.close()
-                print(f"module script wrote as {file_name}")
-         
+            self.requirements_dict[module] = (module_script, module_location)
     
-    def _del_transform(self):
-        # deletes the written transform and requirements scripts
-        os.remove(self.transform_script)
-        print(f"{self.transform_script} removed")
-        for module in self.requirements_dict:
-            file_name = f"{module}.py".replace("-", "_")
-            file_name = f"{file_name}"
-            os.remove(file_name)
-            print(f"{file_name} removed")
+    def _run(self):
+        # imports the transform from memory and runs it, requirements are importable by name
+        print(f"Running transform on: {self.dataset}")
+        with SourceLoader(get_module_sources(self.transform_source, self.transform_origin, self.requirements_dict)) as loader:
+            transform = loader.import_module(transform_module).transform
+            # catch any errors in the transform
+            try:
+                self.transform_output = transform(self.source_files, year_of_data=self.year_of_data)
+            except Exception as e:
+                print(f"Error in transform - {self.dataset}")
+                raise Exception(e)
     
     def run_transform(self):
         # runs the transform 
         
-        # write the transform and any requirements
-        self._write_transform()
-        
-        # import transform
-        sys.path.append(f"")
-        print(f"Running transform on: {self.dataset}")
-        from temp_transform_script import transform
-        # catch any errors in the transform
-        try:
-            self.transform_output = transform(self.source_files, year_of_data=self.year_of_data)
-        except Exception as e:
-            print(f"Error in transform - {self.dataset}")
-            self._del_transform() # del scripts to avoid hangover
-            raise Exception(e)
-        # del scripts
-        self._del_transform()
-        del sys.modules['temp_transform_script'] # causes issue with multipart transform if not deleted
+        # get the transform and any requirements
+        self._get_transform()
+        self._run()
 
     def run_transform_local(self):
         # runs the transform 
         
-        # write the transform and any requirements
-        self._write_transform_local()
-        
-        # import transform
-        sys.path.append(f"")
-        print(f"Running transform on: {self.dataset}")
-        from temp_transform_script import transform
-        # catch any errors in the transform
-        try:
-            self.transform_output = transform(self.source_files, year_of_data=self.year_of_data)
-        except Exception as e:
-            print(f"Error in transform - {self.dataset}")
-            self._del_transform() # del scripts to avoid hangover
-            raise Exception(e)
-        # del scripts
-        self._del_transform()
-        del sys.modules['temp_transform_script'] # causes issue with multipart transform if not deleted
+        # get the transform and any requirements
+        self._get_transform_local()
+        self._run()
 
 class AsheSourceData:
     def __init__(self, table_number, year_of_data, provisional_or_revised, **kwargs):
@@ -293,6 +217,7 @@ class AsheSourceData:
             email = 'cmd@ons.gov.uk' # generic cmd email
 
         self.user_agent = {"User-Agent": f"cmd-run-transforms/Version1.0.0 ONS {email}"}
+        self.cache = HttpCache("landing-pages")
         
     def get_source_files(self):
         if self.table_number not in self.page_details['ashe'].keys():
@@ -300,54 +225,42 @@ class AsheSourceData:
 
         # downloads and writes source files
         self.landing_pages = self.page_details['ashe'][self.table_number]["pages"]
+        # optional glob patterns of the files needed from a zip, all files if not given
+        self.members = self.page_details['ashe'][self.table_number].get("members")
 
-        for page in self.landing_pages:
-            self._download(page)
+        # pages are downloaded concurrently, files are kept in the order of the landing pages
+        with ThreadPoolExecutor(max_workers=len(self.landing_pages)) as executor:
+            for page_files in executor.map(self._download, self.landing_pages):
+                self.downloaded_files.extend(page_files)
 
         return self.downloaded_files
     
     def _download(self, page):
-        results = self._get_results(page)
-        elements = results.find_all("div", class_="inline-block--md margin-bottom-sm--1")
+        # downloads the source file from a landing page, returns list of files
+        downloaded_files = []
+        links = self._get_page_details(page)['links']
         
-        # find correct link
-        for text in elements:
-            if self.year_of_data in str(text):
-                if f'{self.provisional_or_revised}' in str(text):
-                    element = text
+        # find correct link, matched on the html of the whole download element
+        for link in links:
+            if self.year_of_data in link['html']:
+                if f'{self.provisional_or_revised}' in link['html']:
+                    download_link = f"{self.ons_landing_page}{link['href']}"
                     break
-        try: element
+        try: download_link
         except: raise Exception(f"could not find source data for {self.year_of_data}, {self.provisional_or_revised}")
         
-        link = str(element).split("href=")[-1].split(">")[0].strip('"')
-        download_link = f"{self.ons_landing_page}{link}"
-        
         # download the file
         source_file = download_link.split('/')[-1]
-        r = requests.get(download_link, headers=self.user_agent, verify=verify)
-        with open(f"{source_file}", 'wb') as output:
-            output.write(r.content)
-        print(f"written {source_file}")
-            
-        # unzip if needed
         if source_file.endswith(".zip"):
-            with zipfile.ZipFile(f"{source_file}", 'r') as zip_ref:
-                extracted_file = zip_ref.namelist()
-                self.downloaded_files.append(extracted_file[0])
-                zip_ref.extractall("")
-            os.remove(f"{source_file}")
-            print(f"extracted {source_file}")
+            # only the members needed are extracted, the zip itself is not kept
+            downloaded_files.extend(download_and_extract(download_link, self.user_agent, members=self.members))
         else:
-            self.downloaded_files.append(source_file)
+            download_file(download_link, source_file, self.user_agent)
+            downloaded_files.append(source_file)
+
+        return downloaded_files
             
-    def _get_results(self, page):
-        landing_page = f"{self.ons_landing_page}{page}"
-        r = requests.get(landing_page, headers=self.user_agent, verify=verify)
-        if r.status_code != 200:
-            raise Exception(f"{self.ons_landing_page}{page} returned a {r.status_code} error")
-        
-        soup = BeautifulSoup(r.content, "html.parser")
-        
-        results = soup.find(id="main")
-        return results
-    
\ No newline at end of file
+    def _get_page_details(self, page):
+        # release date & download links of a landing page, see get_landing_page
+        return get_landing_page(self.cache, f"{self.ons_landing_page}{page}", self.user_agent)
+    
@@ -1,6 +1,7 @@
-import requests, os, json, datetime, getpass
+import os, json, datetime, getpass, threading
 
 from get_platform import verify, operating_system
+from http_session import get_session
 
 class Base:
     """
@@ -25,6 +26,10 @@ class Base:
             
         self.collection_url = f"{self.dataset_url}/collection"
         
+        # shared keep-alive session, pool sizes can be passed as kwargs
+        self.session = get_session(**kwargs)
+        # stops concurrent requests from refreshing the token at the same time
+        self.token_lock = threading.Lock()
         
         # assigning variables
         self._get_access_token()
@@ -54,7 +59,7 @@ class Base:
         return reponse_dict
     
     def _get_request(self, url, **kwargs):
-        r = requests.get(url, headers=self.headers, verify=verify)
+        r = self.session.get(url, headers=self.headers, verify=verify)
         status_code = r.status_code
         response_dict = r.json()
         
@@ -67,7 +72,7 @@ class Base:
         if 'refresh_token' in kwargs:
             # refreshing token request is different to other put requests
             headers = {"ID": self.headers['ID'], "Refresh": self.refresh_token}
-            r = requests.put(url, headers=headers, verify=verify)
+            r = self.session.put(url, headers=headers, verify=verify)
             status_code = r.status_code
             
             return {
@@ -78,7 +83,7 @@ class Base:
         else: 
             # all put requests should have a json request header
             json_header = kwargs['json']
-            r = requests.put(url, json=json_header, headers=self.headers, verify=verify)
+            r = self.session.put(url, json=json_header, headers=self.headers, verify=verify)
             status_code = r.status_code
             
             return {
@@ -88,7 +93,7 @@ class Base:
     def _post_request(self, url, **kwargs):
         if 'get_access_token' in kwargs:
             login = kwargs['login']
-            r = requests.post(url, json=login)
+            r = self.session.post(url, json=login)
             status_code = r.status_code
             
             return {
@@ -99,14 +104,14 @@ class Base:
         elif 'json' in kwargs:
             # most post requests only pass on json as request header
             json_header = kwargs['json']
-            r = requests.post(url, json=json_header, headers=self.headers, verify=verify)
+            r = self.session.post(url, json=json_header, headers=self.headers, verify=verify)
             status_code = r.status_code
         
         elif 'params' in kwargs and 'files' in kwargs:
             # uploading chunks uses these request headers
             params_dict = kwargs['params']
             files_dict = kwargs['files']
-            r = requests.post(url, params=params_dict, files=files_dict, headers=self.headers, verify=verify)
+            r = self.session.post(url, params=params_dict, files=files_dict, headers=self.headers, verify=verify)
             status_code = r.status_code
         
         return {
@@ -167,12 +172,14 @@ class Base:
         try:
             self.token_start_time
             refresh_time = 10 # will refresh if token is more than 10 minutes old
-            if datetime.datetime.now() - self.token_start_time > datetime.timedelta(minutes=refresh_time):
-                self._refresh_access_token()
+            with self.token_lock:
+                if datetime.datetime.now() - self.token_start_time > datetime.timedelta(minutes=refresh_time):
+                    self._refresh_access_token()
         except:
             return
             
-    def _get_credentials(self):
+    @staticmethod
+    def _get_credentials():
         email = os.getenv('FLORENCE_EMAIL')
         password = os.getenv('FLORENCE_PASSWORD')
         if email and password:
@@ -0,0 +1,195 @@
+import os, math, time, sqlite3
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from get_platform import verify
+from http_session import get_session
+from http_cache import cache_dir
+
+code_list_api_url = "https://api.beta.ons.gov.uk/v1/code-lists"
+
+class CodeListStore:
+    """
+    On disk (sqlite) store of the codes & labels of code lists from the code list api,
+    keyed by code list id & edition
+    Code lists checked within the last ttl seconds are used as they are, older ones are
+    revalidated with the api using their ETag and only fetched again if they have changed,
+    if the api gave no ETag they are always fetched again
+    In offline mode no requests are made and only stored code lists can be used
+    Several code lists can be got at once with get_many, their pages are fetched concurrently
+    A new connection is used for each call so the store can be used from several threads
+    """
+    def __init__(self, **kwargs):
+        if 'offline' in kwargs.keys():
+            self.offline = kwargs['offline']
+        else:
+            self.offline = False
+
+        if 'ttl' in kwargs.keys():
+            self.ttl = kwargs['ttl']
+        else:
+            self.ttl = 24 * 60 * 60
+
+        if 'cache_dir' in kwargs.keys():
+            self.location = os.path.join(kwargs['cache_dir'], "code-lists.sqlite")
+        else:
+            self.location = os.path.join(cache_dir, "code-lists.sqlite")
+
+        if 'headers' in kwargs.keys():
+            self.headers = kwargs['headers']
+        else:
+            self.headers = {}
+
+        # max number of code list requests made at once
+        if 'fetch_workers' in kwargs.keys():
+            self.fetch_workers = kwargs['fetch_workers']
+        else:
+            self.fetch_workers = 8
+
+        self.page_size = 1000
+        self.session = get_session()
+
+        os.makedirs(os.path.dirname(self.location), exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS code_lists (
+                    codelist_id TEXT, edition TEXT, total_count INTEGER, etag TEXT, checked REAL,
+                    PRIMARY KEY (codelist_id, edition)
+                )""")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS codes (
+                    codelist_id TEXT, edition TEXT, code TEXT, label TEXT,
+                    PRIMARY KEY (codelist_id, edition, code)
+                )""")
+
+    def get_many(self, codelist_ids, **kwargs):
+        """
+        Returns dict of codelist_id -> dict of code -> label, for several code lists
+        Code lists are revalidated together, then every page of every code list that has
+        changed is fetched at once, using up to fetch_workers requests at a time
+        edition - code list edition, 'one-off' if not given
+        """
+        if 'edition' in kwargs.keys():
+            edition = kwargs['edition']
+        else:
+            edition = 'one-off'
+
+        code_lists = {}
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+            checks = dict(zip(codelist_ids, executor.map(lambda codelist_id: self._check(codelist_id, edition), codelist_ids)))
+
+            page_futures = {}
+            for codelist_id, check in checks.items():
+                if 'codes' in check:
+                    code_lists[codelist_id] = check['codes']
+                    continue
+                code_lists[codelist_id] = {}
+                number_of_pages = max(math.ceil(check['total_count'] / self.page_size), 1)
+                for page in range(number_of_pages):
+                    future = executor.submit(self._fetch_page, check['codelist_url'], page * self.page_size)
+                    page_futures[future] = codelist_id
+
+            errors = []
+            for future in as_completed(page_futures):
+                try:
+                    code_lists[page_futures[future]].update(future.result())
+                except Exception as e:
+                    errors.append(str(e))
+            if errors:
+                raise Exception(f"Failed to fetch {len(errors)} code list page(s) - {errors}")
+
+        for codelist_id, check in checks.items():
+            if 'codes' not in check:
+                self._write(codelist_id, edition, check['total_count'], check['etag'], code_lists[codelist_id])
+                print(f"{codelist_id} code list updated - {len(code_lists[codelist_id])} codes")
+
+        return code_lists
+
+    def _check(self, codelist_id, edition):
+        """
+        Returns {'codes': stored codes} if the stored code list can be used, otherwise
+        the details needed to fetch it - codelist_url, total_count & etag
+        """
+        stored = self._read_details(codelist_id, edition)
+
+        if self.offline:
+            if stored is None:
+                raise Exception(f"{codelist_id} ({edition}) code list is not stored, cannot fetch it in offline mode")
+            return {'codes': self._read_codes(codelist_id, edition)}
+
+        if stored and time.time() - stored['checked'] < self.ttl:
+            return {'codes': self._read_codes(codelist_id, edition)}
+
+        codelist_url = f"{code_list_api_url}/{codelist_id}/editions/{edition}/codes"
+        headers = dict(self.headers)
+        if stored and stored['etag']:
+            headers['If-None-Match'] = stored['etag']
+
+        r = self.session.get(f"{codelist_url}?limit=1", headers=headers, verify=verify)
+        if r.status_code == 304 and stored:
+            self._mark_checked(codelist_id, edition)
+            return {'codes': self._read_codes(codelist_id, edition)}
+        if r.status_code != 200:
+            raise Exception(f"{codelist_url} returned a {r.status_code} error")
+
+        # without an ETag there is no way to tell the code list is unchanged, a code can be
+        # swapped or relabelled without the count changing, so it is always fetched again
+        total_count = r.json()['total_count']
+        etag = r.headers.get('ETag')
+        return {'codelist_url': codelist_url, 'total_count': total_count, 'etag': etag}
+
+    def _fetch_page(self, codelist_url, offset):
+        # gets a single page of a code list, returns dict of code -> label
+        new_url = f"{codelist_url}?limit={self.page_size}&offset={offset}"
+        r = self.session.get(new_url, headers=self.headers, verify=verify)
+        if r.status_code != 200:
+            raise Exception(f"{new_url} returned a {r.status_code} error")
+        return {item['code']: item.get('label') for item in r.json()['items']}
+
+    @contextmanager
+    def _connect(self):
+        # commits if the block succeeds, rolls back if not, always closes
+        connection = sqlite3.connect(self.location, timeout=30)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _read_details(self, codelist_id, edition):
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT total_count, etag, checked FROM code_lists WHERE codelist_id = ? AND edition = ?",
+                (codelist_id, edition)
+                ).fetchone()
+        if row is None:
+            return None
+        return {'total_count': row[0], 'etag': row[1], 'checked': row[2]}
+
+    def _read_codes(self, codelist_id, edition):
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT code, label FROM codes WHERE codelist_id = ? AND edition = ?", (codelist_id, edition)
+                ).fetchall()
+        return dict(rows)
+
+    def _mark_checked(self, codelist_id, edition):
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE code_lists SET checked = ? WHERE codelist_id = ? AND edition = ?",
+                (time.time(), codelist_id, edition)
+                )
+
+    def _write(self, codelist_id, edition, total_count, etag, codes):
+        # replaces the code list in a single transaction
+        with self._connect() as connection:
+            connection.execute("DELETE FROM codes WHERE codelist_id = ? AND edition = ?", (codelist_id, edition))
+            connection.executemany(
+                "INSERT INTO codes (codelist_id, edition, code, label) VALUES (?, ?, ?, ?)",
+                [(codelist_id, edition, code, label) for code, label in codes.items()]
+                )
+            connection.execute(
+                "INSERT OR REPLACE INTO code_lists (codelist_id, edition, total_count, etag, checked) VALUES (?, ?, ?, ?, ?)",
+                (codelist_id, edition, total_count, etag, time.time())
+                )
@@ -15,18 +15,26 @@ class CollectionClient(Base):
 
     def create_collection(self):
         for dataset_id in self.upload_dict.keys():
-            payload = {"name": self.upload_dict[dataset_id]['collection_name']}
-            response = self.http_request('post', self.collection_url, json=payload)
-            # does not return a 200, so check the collection was created, which
-            # also finds the collection_id
-            self._check_collection_exists(dataset_id)
-            time.sleep(1)
+            self._create_single_collection(dataset_id)
+
+
+    def _create_single_collection(self, dataset_id):
+        payload = {"name": self.upload_dict[dataset_id]['collection_name']}
+        response = self.http_request('post', self.collection_url, json=payload)
+        # does not return a 200, so check the collection was created, which
+        # also finds the collection_id
+        self._check_collection_exists(dataset_id)
+        time.sleep(1)
             
     
     def add_to_collection(self):
         for dataset_id in self.upload_dict.keys():
-            self._add_dataset_to_collection(dataset_id)
-            self._add_dataset_version_to_collection(dataset_id)
+            self._add_single_to_collection(dataset_id)
+
+
+    def _add_single_to_collection(self, dataset_id):
+        self._add_dataset_to_collection(dataset_id)
+        self._add_dataset_version_to_collection(dataset_id)
 
     
     def _check_collection_exists(self, dataset_id):
@@ -1,7 +1,9 @@
 import datetime, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from clients.base_client import Base
 from metadata_client import MetadataClient
+from recipe_store import get_recipe_store
 
 class DatasetClient(Base, MetadataClient):
     """
@@ -16,6 +18,17 @@ class DatasetClient(Base, MetadataClient):
         Base.__init__(self, **kwargs)
         self._assign(upload_dict)
 
+        # bounds for the time between checks on the state of an import, in seconds
+        if 'poll_interval_min' in kwargs.keys():
+            self.poll_interval_min = kwargs['poll_interval_min']
+        else:
+            self.poll_interval_min = 5
+
+        if 'poll_interval_max' in kwargs.keys():
+            self.poll_interval_max = kwargs['poll_interval_max']
+        else:
+            self.poll_interval_max = 120
+
         
     def updating_instance(self):
         ''' 
@@ -23,25 +36,33 @@ class DatasetClient(Base, MetadataClient):
         updates state of instance to create version number
         '''
         for dataset_id in self.upload_dict.keys():
-            # get metadata from previous release
-            self._get_latest_metadata(dataset_id, self.upload_dict[dataset_id]['edition'])
-            
-            # updating general metadata
-            self._update_metadata(dataset_id)
-            
-            # assigning instance a version number
-            self._create_new_version_from_instance(dataset_id)
+            self._update_single_instance(dataset_id)
+
+
+    def _update_single_instance(self, dataset_id):
+        # get metadata from previous release
+        self._get_latest_metadata(dataset_id, self.upload_dict[dataset_id]['edition'])
+        
+        # updating general metadata
+        self._update_metadata(dataset_id)
+        
+        # assigning instance a version number
+        self._create_new_version_from_instance(dataset_id)
         
     
     def adding_metadata(self):
         for dataset_id in self.upload_dict.keys():
-            try:
-                self.upload_dict[dataset_id]["metadata_dict"]
-            except:
-                print(f"No metadata available for {dataset_id}")
-                return
-            self._update_dimensions(dataset_id)
-            self._update_usage_notes(dataset_id)
+            self._add_single_metadata(dataset_id)
+
+
+    def _add_single_metadata(self, dataset_id):
+        try:
+            self.upload_dict[dataset_id]["metadata_dict"]
+        except:
+            print(f"No metadata available for {dataset_id}")
+            return
+        self._update_dimensions(dataset_id)
+        self._update_usage_notes(dataset_id)
             
         
     def _get_latest_job(self):
@@ -83,23 +104,11 @@ class DatasetClient(Base, MetadataClient):
             if self.upload_dict[dataset_id]['recipe_id']:
                 pass
         except:
-            response = self.http_request('get', f"{self.recipe_url}?limit=1000")
-
-            if response['status_code'] == 200:
-                all_recipes = response['response_dict']
-            else:
-                raise Exception(f"Recipe API returned a {response['status_code']} error")
-            
-            for item in all_recipes["items"]:
-                # hack around incorrect recipe in database
-                if item['id'] == 'b944be78-f56d-409b-9ebd-ab2b77ffe187':
-                    continue
-                if dataset_id == item["output_instances"][0]["dataset_id"]:
-                    self.upload_dict[dataset_id]['dataset_recipe'] = item
-                    self.upload_dict[dataset_id]['recipe_id'] = self.upload_dict[dataset_id]['dataset_recipe']["id"]
-                    return
-            else:
-                raise Exception(f"Unable to find recipe for dataset id {self.dataset_id}")
+            recipes = get_recipe_store().get(self, dataset_id)
+            if not recipes:
+                raise Exception(f"Unable to find recipe for dataset id {dataset_id}")
+            self.upload_dict[dataset_id]['dataset_recipe'] = recipes[0]
+            self.upload_dict[dataset_id]['recipe_id'] = self.upload_dict[dataset_id]['dataset_recipe']["id"]
     
     
     def post_new_job(self):
@@ -213,12 +222,79 @@ class DatasetClient(Base, MetadataClient):
             print(self.upload_dict[dataset_id]['instance_id'])
         
 
-    def monitor_upload(self):
-        for dataset_id in self.upload_dict.keys():
-            self.upload_dict[dataset_id]['upload_state'] = ""
-            while self.upload_dict[dataset_id]['upload_state'] != "completed":
-                time.sleep(30) # checks every 30 seconds
-                self.upload_dict[dataset_id]['upload_state'] = self._get_upload_state(dataset_id)
+    def monitor_upload(self, **kwargs):
+        """
+        Monitors the imports of every instance in upload_dict at the same time
+        If on_complete is passed it is called with the dataset_id as soon as that
+        dataset's import is complete, without waiting for the others
+        on_complete is always called from this thread, one dataset at a time
+        """
+        if 'on_complete' in kwargs.keys():
+            on_complete = kwargs['on_complete']
+        else:
+            on_complete = None
+
+        if not self.upload_dict:
+            # nothing was uploaded
+            return
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=len(self.upload_dict)) as executor:
+            futures = {
+                executor.submit(self._monitor_single_upload, dataset_id): dataset_id 
+                for dataset_id in self.upload_dict.keys()
+                }
+            for future in as_completed(futures):
+                dataset_id = futures[future]
+                try:
+                    future.result()
+                    if on_complete:
+                        on_complete(dataset_id)
+                except Exception as e:
+                    print(f"{dataset_id} - failed - {e}")
+                    errors.append(f"{dataset_id} - {e}")
+
+        if errors:
+            raise Exception(f"Upload failed for {len(errors)} dataset(s) - {errors}")
+
+
+    def _monitor_single_upload(self, dataset_id):
+        self.upload_dict[dataset_id]['upload_state'] = ""
+        interval = self.poll_interval_min # checks quickly to begin with
+        first_check = None
+        while self.upload_dict[dataset_id]['upload_state'] != "completed":
+            time.sleep(interval)
+            self.upload_dict[dataset_id]['upload_state'] = self._get_upload_state(dataset_id)
+            if self.upload_dict[dataset_id]['upload_state'] != "submitted":
+                continue
+
+            # rate is measured from the first check made while the import was running
+            if first_check is None:
+                first_check = (time.time(), self.upload_dict[dataset_id]['inserted_observations'])
+            interval = self._next_poll_interval(dataset_id, interval, first_check)
+    
+
+    def _next_poll_interval(self, dataset_id, interval, first_check):
+        """
+        Estimates time left on the import from the rate observations are being inserted
+        Polls at roughly half the time left, backs off if no progress has been made yet
+        Interval is kept between self.poll_interval_min and self.poll_interval_max
+        """
+        first_time, first_inserted = first_check
+        inserted = self.upload_dict[dataset_id]['inserted_observations']
+        total = self.upload_dict[dataset_id]['total_observations']
+        elapsed = time.time() - first_time
+
+        if elapsed <= 0 or inserted <= first_inserted:
+            # no rate to go on yet
+            next_interval = interval * 2
+        else:
+            rate = (inserted - first_inserted) / elapsed
+            eta = (total - inserted) / rate
+            print(f"{dataset_id} - importing at {rate:.0f} observations per second, about {eta:.0f} seconds remaining")
+            next_interval = eta / 2
+
+        return min(max(next_interval, self.poll_interval_min), self.poll_interval_max)
     
     
     def _get_upload_state(self, dataset_id):
@@ -251,7 +327,9 @@ class DatasetClient(Base, MetadataClient):
             except:
                 error_message = dataset_instance_dict["events"][0]["message"]
                 raise Exception(error_message)
-            print("Import process is running")
+            self.upload_dict[dataset_id]['inserted_observations'] = total_inserted_observations
+            self.upload_dict[dataset_id]['total_observations'] = total_observations
+            print(f"{dataset_id} - Import process is running")
             print(
                 f"{total_inserted_observations} out of {total_observations} observations have been imported"
             )
@@ -0,0 +1,156 @@
+import os, json, hashlib, time, threading
+
+from http_session import get_session
+
+# hidden so that ClearRepo and the source file globbing ignore it
+cache_dir = ".cmd-cache"
+
+class HttpCache:
+    """
+    On disk cache of GET responses, used for files that are fetched on every run
+    Content is stored once under its sha256 (objects/<sha256>), each url has an index
+    entry pointing at its content along with its ETag & Last-Modified
+    Cached urls are revalidated with If-None-Match/If-Modified-Since and a 304 is served
+    from disk, urls checked within the last max_age seconds are not revalidated
+    In offline mode no requests are made and only cached responses can be returned
+    Values worked out from a response (i.e. parsed pages) can be stored against its
+    content with write_derived, so they are only worked out again when the content changes
+    Index entries and objects are replaced atomically, so the cache can be shared by
+    threads and worker processes
+    """
+    def __init__(self, namespace, **kwargs):
+        if 'offline' in kwargs.keys():
+            self.offline = kwargs['offline']
+        else:
+            self.offline = False
+
+        if 'max_age' in kwargs.keys():
+            self.max_age = kwargs['max_age']
+        else:
+            self.max_age = 300
+
+        # can be given explicitly for when the working directory is changed
+        if 'cache_dir' in kwargs.keys():
+            self.location = os.path.join(kwargs['cache_dir'], namespace)
+        else:
+            self.location = os.path.join(cache_dir, namespace)
+        os.makedirs(os.path.join(self.location, "index"), exist_ok=True)
+        os.makedirs(os.path.join(self.location, "objects"), exist_ok=True)
+        self.session = get_session()
+
+    def get(self, url, **kwargs):
+        """
+        Returns a dict of status_code, content (bytes), sha256 (of the content) & from_cache
+        404s are cached too so offline runs know a file does not exist
+        Any other error is returned without being cached
+        max_age can be given to override the cache's max_age for this request, 0 always revalidates
+        """
+        if 'headers' in kwargs.keys():
+            headers = dict(kwargs['headers'])
+        else:
+            headers = {}
+
+        if 'max_age' in kwargs.keys():
+            max_age = kwargs['max_age']
+        else:
+            max_age = self.max_age
+
+        entry = self._read_entry(url)
+
+        if self.offline:
+            if entry is None:
+                raise Exception(f"{url} is not in the cache, cannot fetch it in offline mode")
+            return self._cached_response(entry)
+
+        if entry and time.time() - entry['checked'] < max_age:
+            return self._cached_response(entry)
+
+        if entry and entry['status_code'] == 200:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        r = self.session.get(url, headers=headers)
+
+        if r.status_code == 304 and entry:
+            entry['checked'] = time.time()
+            self._write_entry(url, entry)
+            return self._cached_response(entry)
+
+        if r.status_code not in (200, 404):
+            return {'status_code': r.status_code, 'content': r.content, 'sha256': None, 'from_cache': False}
+
+        entry = {
+            'url': url,
+            'status_code': r.status_code,
+            'sha256': None,
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+            'checked': time.time()
+        }
+        if r.status_code == 200:
+            entry['sha256'] = self._write_object(r.content)
+        self._write_entry(url, entry)
+
+        return {'status_code': r.status_code, 'content': r.content, 'sha256': entry['sha256'], 'from_cache': False}
+
+    def read_derived(self, sha256, kind):
+        # returns the value stored by write_derived for this content, None if there is not one
+        derived_path = self._derived_path(sha256, kind)
+        if not os.path.exists(derived_path):
+            return None
+        with open(derived_path) as f:
+            return json.load(f)
+
+    def write_derived(self, sha256, kind, value):
+        # stores a json serialisable value worked out from the content with this sha256
+        derived_path = self._derived_path(sha256, kind)
+        os.makedirs(os.path.dirname(derived_path), exist_ok=True)
+        self._atomic_write(derived_path, json.dumps(value).encode("utf-8"))
+
+    def _cached_response(self, entry):
+        if entry['status_code'] == 200:
+            with open(self._object_path(entry['sha256']), 'rb') as f:
+                content = f.read()
+        else:
+            content = b""
+        return {'status_code': entry['status_code'], 'content': content, 'sha256': entry['sha256'], 'from_cache': True}
+
+    def _entry_path(self, url):
+        url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.location, "index", f"{url_hash}.json")
+
+    def _object_path(self, sha256):
+        return os.path.join(self.location, "objects", sha256)
+
+    def _derived_path(self, sha256, kind):
+        return os.path.join(self.location, "derived", kind, f"{sha256}.json")
+
+    def _read_entry(self, url):
+        entry_path = self._entry_path(url)
+        if not os.path.exists(entry_path):
+            return None
+        with open(entry_path) as f:
+            entry = json.load(f)
+        # content may have been removed by hand
+        if entry['status_code'] == 200 and not os.path.exists(self._object_path(entry['sha256'])):
+            return None
+        return entry
+
+    def _write_entry(self, url, entry):
+        entry_path = self._entry_path(url)
+        self._atomic_write(entry_path, json.dumps(entry).encode("utf-8"))
+
+    def _write_object(self, content):
+        sha256 = hashlib.sha256(content).hexdigest()
+        object_path = self._object_path(sha256)
+        if not os.path.exists(object_path):
+            self._atomic_write(object_path, content)
+        return sha256
+
+    def _atomic_write(self, path, content):
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        os.replace(temp_path, path)
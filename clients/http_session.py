@@ -0,0 +1,40 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+from get_platform import verify
+
+# one pooled session per process, shared by every client so that connections
+# (and their TLS handshakes) are reused across requests
+_session = None
+_session_lock = threading.Lock()
+
+def get_session(**kwargs):
+    """
+    Returns the shared requests session, creating it on first use
+    Connections are kept alive and pooled per host
+    pool_connections - number of hosts to keep a pool for
+    pool_maxsize - max number of connections kept open to a single host
+    Only the first call's pool sizes are used, later calls return the same session
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            if 'pool_connections' in kwargs.keys():
+                pool_connections = kwargs['pool_connections']
+            else:
+                pool_connections = 10
+
+            if 'pool_maxsize' in kwargs.keys():
+                pool_maxsize = kwargs['pool_maxsize']
+            else:
+                pool_maxsize = 20
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.verify = verify
+            _session = session
+
+    return _session
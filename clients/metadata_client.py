@@ -1,6 +1,7 @@
-import requests, json
+import json
 
 from get_platform import verify
+from http_session import get_session
 
 class MetadataClient:
     """
@@ -19,17 +20,18 @@ class MetadataClient:
         """
         Pulls latest csvw
         """
+        session = get_session()
         editions_url = f"https://api.beta.ons.gov.uk/v1/datasets/{dataset_id}/editions/{edition}/versions"
-        items = requests.get(f"{editions_url}?limit=1000", verify=verify).json()['items']
+        items = session.get(f"{editions_url}?limit=1000", verify=verify).json()['items']
         # get latest version number
         latest_version_number = items[0]['version']
         assert latest_version_number == len(items), f'Get_Latest_Version for /{dataset_id}/editions/{edition} - number of versions does not match latest version number'
         # get latest version URL
         url = f"{editions_url}/{str(latest_version_number)}"
         # get latest version data
-        latest_version = requests.get(url, verify=verify).json()
+        latest_version = session.get(url, verify=verify).json()
         try:
-            csvw_response = requests.get(latest_version['downloads']['csvw']['href'], verify=verify)
+            csvw_response = session.get(latest_version['downloads']['csvw']['href'], verify=verify)
             if csvw_response.status_code != 200:
                 print(f"csvw download failed with a {csvw_response.status_code} error")
                 return 
@@ -0,0 +1,205 @@
+import threading, time, os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from base_client import Base
+from source_data_client import SourceData, DownloadManager
+from transform_client import TransformPool
+from v4_checker_client import V4Checker
+from upload_details_client import UploadDetails
+from upload_to_cmd_client import UploadToCmd
+
+# stages are run in this order for each dataset
+pipeline_stages = ["download", "transform", "validate", "upload", "monitor", "collection"]
+
+class Pipeline:
+    """
+    Client responsible for running each dataset through the whole process as its own task
+    download -> transform -> validate -> upload -> monitor -> collection
+    Datasets do not wait for each other, so one dataset can be uploading while another
+    is still transforming
+    The number of datasets allowed in a stage at once is set per stage with stage_workers
+    Validate, upload, monitor & collection are only run if upload is True, a 'partial'
+    upload stops after monitor
+    """
+    def __init__(self, datasets, **kwargs):
+        assert type(datasets) == list, f"Pipeline datasets must be a list, got '{type(datasets)}'"
+        self.datasets = datasets
+
+        if 'upload' in kwargs.keys():
+            self.upload = kwargs['upload']
+        else:
+            self.upload = False
+
+        if 'run_locally' in kwargs.keys():
+            self.run_locally = kwargs['run_locally']
+        else:
+            self.run_locally = False
+
+        if 'ignore_release_date' in kwargs.keys():
+            self.ignore_release_date = kwargs['ignore_release_date']
+        else:
+            self.ignore_release_date = False
+
+        # writes a parquet sidecar of each v4, which validation reads instead of the csv
+        if 'sidecar' in kwargs.keys():
+            self.sidecar = kwargs['sidecar']
+        else:
+            self.sidecar = False
+
+        # checks v4 labels against the code lists when validating
+        if 'check_labels' in kwargs.keys():
+            self.check_labels = kwargs['check_labels']
+        else:
+            self.check_labels = True
+
+        # polls the landing pages until the release goes live before downloading
+        if 'watch_release' in kwargs.keys():
+            self.watch_release = kwargs['watch_release']
+        else:
+            self.watch_release = False
+
+        # uses cached transform scripts & code lists without fetching them
+        if 'offline' in kwargs.keys():
+            self.offline = kwargs['offline']
+        else:
+            self.offline = False
+
+        # dict of dataset -> source files, for datasets that are given source files directly
+        if 'source_files' in kwargs.keys() and kwargs['source_files']:
+            self.source_files = kwargs['source_files']
+        else:
+            self.source_files = {}
+
+        # downloads are limited per host by the DownloadManager
+        # each transform runs in its own process
+        # upload handles its own concurrency when posting chunks
+        self.stage_workers = {
+            "download": len(datasets),
+            "transform": os.cpu_count(),
+            "validate": 2,
+            "upload": 1,
+            "monitor": len(datasets),
+            "collection": 1
+        }
+        if 'stage_workers' in kwargs.keys():
+            for stage in kwargs['stage_workers']:
+                assert stage in pipeline_stages, f"'{stage}' is not a pipeline stage, must be one of {pipeline_stages}"
+                self.stage_workers[stage] = int(kwargs['stage_workers'][stage])
+
+        self.semaphores = {stage: threading.Semaphore(self.stage_workers[stage]) for stage in pipeline_stages}
+        self.timings = {dataset: {} for dataset in datasets}
+        self.transform_output = {}
+        self.upload_dict = {}
+        self.output_lock = threading.Lock()
+
+    def run(self):
+        if self.upload:
+            # asks for florence credentials now (if needed) rather than from a worker thread
+            Base._get_credentials()
+
+        self.transform_pool = TransformPool(
+            processes=self.stage_workers["transform"], run_locally=self.run_locally, offline=self.offline,
+            sidecar=self.sidecar
+            )
+
+        # every dataset's source files start downloading now, alongside the transforms
+        # when watching, each dataset downloads as soon as its own release goes live
+        self.downloads = DownloadManager({
+            dataset: SourceData(dataset, ignore_release_date=self.ignore_release_date, watch_release=self.watch_release)
+            for dataset in self.datasets if dataset not in self.source_files
+            }).start()
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=len(self.datasets)) as executor:
+            futures = {executor.submit(self._run_dataset, dataset): dataset for dataset in self.datasets}
+            for future in as_completed(futures):
+                dataset = futures[future]
+                try:
+                    future.result()
+                    print(f"{dataset} - pipeline complete")
+                except Exception as e:
+                    print(f"{dataset} - pipeline failed - {e}")
+                    errors.append(f"{dataset} - {e}")
+
+        self.downloads.shutdown()
+        self.transform_pool.shutdown()
+
+        self._print_timings()
+        if errors:
+            raise Exception(f"Pipeline failed for {len(errors)} dataset(s) - {errors}")
+
+    def _run_dataset(self, dataset):
+        source_files = self._run_stage(dataset, "download", self._download, dataset)
+        transform_output = self._run_stage(dataset, "transform", self._transform, dataset, source_files)
+        with self.output_lock:
+            self.transform_output.update(transform_output)
+
+        if not self.upload:
+            return
+
+        self._run_stage(dataset, "validate", self._validate, transform_output)
+        upload_client = self._run_stage(dataset, "upload", self._upload, transform_output)
+        self._run_stage(dataset, "monitor", upload_client.monitor_upload)
+
+        if self.upload != 'partial':
+            self._run_stage(dataset, "collection", self._collection, upload_client)
+
+        # only datasets that have been through every stage, these are emailed about
+        with self.output_lock:
+            self.upload_dict.update(upload_client.upload_dict)
+
+    def _run_stage(self, dataset, stage, function, *args):
+        # waits for space in the stage, then runs it and records how long it took
+        with self.semaphores[stage]:
+            print(f"{dataset} - starting {stage}")
+            start = time.time()
+            result = function(*args)
+            self.timings[dataset][stage] = time.time() - start
+            print(f"{dataset} - {stage} complete in {self.timings[dataset][stage]:.1f} seconds")
+        return result
+
+    def _download(self, dataset):
+        if dataset in self.source_files:
+            return self.source_files[dataset]
+
+        source_files = self.downloads.result(dataset)
+        if not source_files:
+            # the transform uses the files in the current directory, which other datasets
+            # may still be downloading into
+            self.downloads.wait_all()
+        return source_files
+
+    def _transform(self, dataset, source_files):
+        if self.run_locally:
+            print("running transform locally")
+        return self.transform_pool.run(dataset, source_files)
+
+    def _validate(self, transform_output):
+        validate_object = V4Checker(transform_output, offline=self.offline, check_labels=self.check_labels)
+        validate_object.run_check()
+
+    def _upload(self, transform_output):
+        upload_dict = UploadDetails(transform_output).create()
+        upload_client = UploadToCmd(upload_dict)
+
+        # gets recipe details
+        upload_client.get_recipe()
+
+        # upload v4 into s3 bucket
+        upload_client.post_v4_to_s3()
+
+        # start upload into CMD
+        upload_client.post_new_job()
+        return upload_client
+
+    def _collection(self, upload_client):
+        for dataset_id in upload_client.upload_dict.keys():
+            upload_client._complete_single_upload(dataset_id)
+
+    def _print_timings(self):
+        print("---")
+        print("Pipeline timings (seconds)")
+        for dataset in self.timings:
+            stage_timings = [f"{stage} {self.timings[dataset][stage]:.1f}" for stage in pipeline_stages if stage in self.timings[dataset]]
+            print(f"{dataset} - {', '.join(stage_timings)} - total {sum(self.timings[dataset].values()):.1f}")
+        print("---")
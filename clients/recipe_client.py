@@ -1,4 +1,5 @@
 from clients.base_client import Base
+from recipe_store import get_recipe_store
 
 class RecipeClient(Base):
     """
@@ -9,58 +10,28 @@ class RecipeClient(Base):
     def __init__(self, upload_dict, **kwargs):
         Base.__init__(self, **kwargs)
         self._assign(upload_dict)
-        # assigning given variables
-        self.all_recipes = None
+        # recipes are shared with every other client
+        self.recipe_store = get_recipe_store()
 
-        
-    def _get_all_recipes(self):
-        """
-        Gets all recipes from the recipe api.
-        """
-        if self.all_recipes:
-            return self.all_recipes
-        
-        response = self.http_request('get', f"{self.recipe_url}?limit=1000")
-
-        if response['status_code'] == 200:
-            self.all_recipes = response['response_dict']
-        else:
-            raise Exception(f"Recipe API returned a {response['status_code']} error")
-        
     
     def _check_recipe_exists(self, dataset_id):
         """
         Checks to make sure a recipe exists for dataset_id
-        Returns nothing if recipe exists, raise an error if not
-        Uses self.get_all_recipes()
+        Returns the recipe if it exists, raise an error if not
+        If there is more than one recipe the last is used
         """
-        self._get_all_recipes()
-
-        # create a list of all existing dataset ids
-        dataset_id_list = []
-        for item in self.all_recipes["items"]:
-            # hack around incorrect recipe in database
-            if item['id'] == 'b944be78-f56d-409b-9ebd-ab2b77ffe187':
-                continue
-            dataset_id_list.append(item["output_instances"][0]["dataset_id"])
-        if dataset_id not in dataset_id_list:
+        recipes = self.recipe_store.get(self, dataset_id)
+        if not recipes:
             raise Exception(f"Recipe does not exist for {dataset_id}")
+        return recipes[-1]
     
     
     def get_recipe(self):
         """
         Returns recipe for specific dataset
-        Uses self.get_all_recipes()
         dataset_id is the dataset_id from the recipe
         """ 
         # iterate through dataset_ids in upload_dict
         for dataset_id in self.upload_dict.keys():
-            self._check_recipe_exists(dataset_id)
-            # iterate through recipe api to find correct dataset_id
-            for item in self.all_recipes["items"]:
-                # hack around incorrect recipe in database
-                if item['id'] == 'b944be78-f56d-409b-9ebd-ab2b77ffe187':
-                    continue
-                if dataset_id == item["output_instances"][0]["dataset_id"]:
-                    self.upload_dict[dataset_id]['dataset_recipe'] = item
-                    self.upload_dict[dataset_id]['recipe_id'] = self.upload_dict[dataset_id]['dataset_recipe']["id"]
+            self.upload_dict[dataset_id]['dataset_recipe'] = self._check_recipe_exists(dataset_id)
+            self.upload_dict[dataset_id]['recipe_id'] = self.upload_dict[dataset_id]['dataset_recipe']["id"]
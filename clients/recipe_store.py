@@ -0,0 +1,103 @@
+import os, json, time, threading
+
+from http_cache import cache_dir
+
+# incorrect recipe(s) in the database, never used
+bad_recipe_ids = ['b944be78-f56d-409b-9ebd-ab2b77ffe187']
+
+# one store per process, shared by every client
+_recipe_store = None
+_recipe_store_lock = threading.Lock()
+
+def get_recipe_store(**kwargs):
+    """
+    Returns the shared RecipeStore, creating it on first use
+    Only the first call's kwargs are used, later calls return the same store
+    """
+    global _recipe_store
+    with _recipe_store_lock:
+        if _recipe_store is None:
+            _recipe_store = RecipeStore(**kwargs)
+    return _recipe_store
+
+class RecipeStore:
+    """
+    All recipes from the recipe api, fetched once and indexed by the dataset_id of their
+    first output instance, a dataset_id can have more than one recipe
+    By default recipes are fetched once per run and not written to disk, with a ttl they are
+    written to .cmd-cache and reused by later runs for ttl seconds, if a dataset_id is not
+    found in recipes read from disk they are fetched again in case the recipe is new (an
+    edited recipe is not noticed until the ttl is up)
+    Recipes are fetched through a Base client, so the client's access token is used
+    """
+    def __init__(self, **kwargs):
+        # seconds that recipes written to disk are used for, 0 to not use the disk
+        if 'ttl' in kwargs.keys():
+            self.ttl = kwargs['ttl']
+        else:
+            self.ttl = 0
+
+        if 'cache_dir' in kwargs.keys():
+            self.location = os.path.join(kwargs['cache_dir'], "recipes.json")
+        else:
+            self.location = os.path.join(cache_dir, "recipes.json")
+
+        self.recipes = None # dataset_id -> list of recipes, in recipe api order
+        self.from_disk = False
+        self.warned = set() # dataset_ids already warned about having several recipes
+        self.lock = threading.Lock()
+
+    def get(self, client, dataset_id):
+        """
+        Returns list of every recipe for dataset_id in recipe api order, empty if there are none
+        client is any Base client, used to fetch the recipes
+        """
+        with self.lock:
+            if self.recipes is None:
+                self._load(client)
+            if dataset_id not in self.recipes and self.from_disk:
+                # recipe may have been created since the recipes were written
+                self._fetch(client)
+            recipes = self.recipes.get(dataset_id, [])
+            if len(recipes) > 1 and dataset_id not in self.warned:
+                self.warned.add(dataset_id)
+                print(f"Warning - {dataset_id} has {len(recipes)} recipes - {[recipe['id'] for recipe in recipes]}")
+            return recipes
+
+    def _load(self, client):
+        # uses the recipes on disk if they are fresh enough, otherwise fetches them
+        if self.ttl and os.path.exists(self.location):
+            with open(self.location) as f:
+                stored = json.load(f)
+            if stored['recipe_url'] == client.recipe_url and time.time() - stored['fetched'] < self.ttl:
+                self.recipes = self._index(stored['items'])
+                self.from_disk = True
+                return
+        self._fetch(client)
+
+    def _fetch(self, client):
+        response = client.http_request('get', f"{client.recipe_url}?limit=1000")
+        if response['status_code'] != 200:
+            raise Exception(f"Recipe API returned a {response['status_code']} error")
+
+        items = response['response_dict']['items']
+        self.recipes = self._index(items)
+        self.from_disk = False
+
+        if self.ttl:
+            self._write(client.recipe_url, items)
+
+    def _index(self, items):
+        recipes = {}
+        for item in items:
+            if item['id'] in bad_recipe_ids:
+                continue
+            recipes.setdefault(item["output_instances"][0]["dataset_id"], []).append(item)
+        return recipes
+
+    def _write(self, recipe_url, items):
+        os.makedirs(os.path.dirname(self.location), exist_ok=True)
+        temp_location = f"{self.location}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_location, 'w') as f:
+            json.dump({'recipe_url': recipe_url, 'fetched': time.time(), 'items': items}, f)
+        os.replace(temp_location, self.location)
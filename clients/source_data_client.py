@@ -1,7 +1,200 @@
-import requests, os, json, datetime, zipfile
-from bs4 import BeautifulSoup
+import os, json, datetime, zipfile, time, threading, fnmatch, random, importlib.util
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, wait
+from bs4 import BeautifulSoup, SoupStrainer
 
 from get_platform import verify
+from http_session import get_session
+from zip_stream import extract_zip_stream, ZipStreamError
+from http_cache import HttpCache
+
+# lxml is optional, it parses landing pages a lot faster than html.parser
+if importlib.util.find_spec("lxml"):
+    html_parser = "lxml"
+else:
+    html_parser = "html.parser"
+
+# max number of requests made to a single host at once, across all downloads
+host_limit = 4
+_host_semaphores = {}
+_host_lock = threading.Lock()
+
+def host_slot(url):
+    """
+    Returns the semaphore for the host of url, used as
+    with host_slot(url):
+        ...request...
+    """
+    host = urlparse(url).netloc
+    with _host_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.Semaphore(host_limit)
+        return _host_semaphores[host]
+
+# bumped whenever the output of _parse_landing_page changes, so old parses are not reused
+page_details_version = 3
+_page_locks = {}
+_page_locks_lock = threading.Lock()
+
+def _page_lock(url):
+    # stops two datasets fetching and parsing the same page at the same time
+    with _page_locks_lock:
+        if url not in _page_locks:
+            _page_locks[url] = threading.Lock()
+        return _page_locks[url]
+
+def get_landing_page(cache, landing_page, headers, **kwargs):
+    """
+    Returns the details of a landing page as a dict of
+    release_date - the release date shown on the page, i.e. '16 October 2025'
+    links - list of dicts of href, label & html (of the whole download element), one for each
+    download on the page, latest first
+    Pages are fetched through cache (HttpCache), so are revalidated with ons using
+    ETag/Last-Modified and only downloaded again when they have changed
+    Pages are parsed once per version of the page, the details are stored in the cache
+    revalidate - checks the page with ons even if it was checked within the cache's max_age
+    """
+    if 'revalidate' in kwargs.keys() and kwargs['revalidate']:
+        max_age = 0
+    else:
+        max_age = cache.max_age
+
+    with _page_lock(landing_page):
+        with host_slot(landing_page):
+            r = cache.get(landing_page, headers=headers, max_age=max_age)
+        if r['status_code'] != 200:
+            raise Exception(f"{landing_page} returned a {r['status_code']} error")
+
+        kind = f"page-details-{page_details_version}"
+        page_details = cache.read_derived(r['sha256'], kind)
+        if page_details is None:
+            page_details = _parse_landing_page(r['content'])
+            cache.write_derived(r['sha256'], kind, page_details)
+
+    return page_details
+
+def _parse_landing_page(content):
+    # only the main section is built into a tree, the header, navigation & footer are skipped
+    results = BeautifulSoup(content, html_parser, parse_only=SoupStrainer(id="main")).find(id="main")
+    if results is None:
+        raise Exception("landing page has no main section")
+
+    # second meta item is the release date, i.e. 'Release date:', '16 October 2025'
+    elements = results.find_all("li", class_="col col--md-12 col--lg-15 meta__item")
+    release_date = list(elements[1].stripped_strings)[-1]
+
+    links = []
+    for element in results.find_all("div", class_="inline-block--md margin-bottom-sm--1"):
+        anchors = element.find_all("a", href=True)
+        if not anchors:
+            continue
+        anchor = anchors[-1]
+        # aria-label has the full description, i.e. edition & file type, the text is often just the file type
+        label = anchor.get("aria-label") or element.get_text(" ", strip=True)
+        links.append({'href': anchor["href"], 'label': label, 'html': str(element)})
+
+    return {'release_date': release_date, 'links': links}
+
+def download_file(download_link, source_file, headers):
+    """
+    Streams download_link to source_file a chunk at a time so the file is never held in memory
+    Written to source_file.part and renamed once complete, so a failed download does not
+    leave a partial source file behind
+    Checks the size of the download against the Content-Length
+    """
+    session = get_session()
+    # the same file can be downloaded by two datasets at once
+    temp_file = f"{source_file}.{threading.get_ident()}.part"
+    start = time.time()
+    written = 0
+    try:
+        with host_slot(download_link), session.get(download_link, headers=headers, verify=verify, stream=True) as r:
+            if r.status_code != 200:
+                raise Exception(f"{download_link} returned a {r.status_code} error")
+
+            # content-length is the compressed size if the response is encoded
+            if 'Content-Length' in r.headers and 'Content-Encoding' not in r.headers:
+                expected_size = int(r.headers['Content-Length'])
+            else:
+                expected_size = None
+
+            with open(temp_file, 'wb') as output:
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    output.write(chunk)
+                    written += len(chunk)
+
+        if expected_size is not None and written != expected_size:
+            raise Exception(f"{download_link} download incomplete, got {written} of {expected_size} bytes")
+
+    except:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+    os.replace(temp_file, source_file)
+
+    download_time = time.time() - start
+    megabytes = written / (1024 * 1024)
+    print(f"written {source_file} - {megabytes:.1f} MB in {download_time:.1f} seconds ({megabytes / max(download_time, 0.001):.2f} MB/s)")
+
+def download_and_extract(download_link, headers, **kwargs):
+    """
+    Streams a zip from download_link and extracts it as it downloads, the zip is never
+    written to disk
+    members - list of glob patterns of the files needed, if not given only the first file in
+    the zip is extracted (as it always has been)
+    Falls back to downloading the zip and using zipfile if it cannot be read as a stream
+    Returns list of extracted files
+    """
+    if 'members' in kwargs.keys():
+        members = kwargs['members']
+    else:
+        members = None
+
+    session = get_session()
+    start = time.time()
+    try:
+        with host_slot(download_link), session.get(download_link, headers=headers, verify=verify, stream=True) as r:
+            if r.status_code != 200:
+                raise Exception(f"{download_link} returned a {r.status_code} error")
+            extracted_files = extract_zip_stream(r.iter_content(chunk_size=1024 * 1024), members=members, first_only=not members)
+
+    except ZipStreamError as e:
+        print(f"could not extract {download_link} while downloading ({e}), downloading zip instead")
+        source_file = download_link.split('/')[-1]
+        download_file(download_link, source_file, headers)
+        extracted_files = extract_zip_file(source_file, members=members, first_only=not members)
+        os.remove(source_file)
+
+    if not extracted_files:
+        raise Exception(f"no files in {download_link} match {members}")
+
+    print(f"extracted {len(extracted_files)} file(s) from {download_link} in {time.time() - start:.1f} seconds")
+    return extracted_files
+
+def extract_zip_file(source_file, **kwargs):
+    # extracts members matching the patterns from a zip on disk, returns list of extracted files
+    # first_only - only the first matching member is extracted
+    if 'members' in kwargs.keys() and kwargs['members']:
+        members = kwargs['members']
+    else:
+        members = ["*"]
+
+    if 'first_only' in kwargs.keys():
+        first_only = kwargs['first_only']
+    else:
+        first_only = False
+
+    extracted_files = []
+    with zipfile.ZipFile(source_file, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if info.is_dir():
+                continue
+            if any(fnmatch.fnmatch(info.filename, pattern) for pattern in members):
+                extracted_files.append(zip_ref.extract(info, ""))
+                if first_only:
+                    break
+    return extracted_files
 
 class SourceData:
     """
@@ -12,12 +205,37 @@ class SourceData:
     it is correct  release - this can be ignored
     Has built in functionality to download the latest version of a previous edition 
     (ie previous years data), was used for weekly deaths
+    Landing pages are downloaded concurrently and cached, see get_landing_page
+    With watch_release the landing pages are polled until the release goes live, then
+    the source files are downloaded straight away, see wait_for_release
     """
     def __init__(self, dataset, **kwargs):
         if 'ignore_release_date' in kwargs.keys():
             self.ignore_release_date = kwargs['ignore_release_date']
         else:
             self.ignore_release_date = False
+
+        if 'watch_release' in kwargs.keys():
+            self.watch_release = kwargs['watch_release']
+        else:
+            self.watch_release = False
+
+        # seconds between polls of the landing pages when watching for the release
+        if 'watch_interval_min' in kwargs.keys():
+            self.watch_interval_min = kwargs['watch_interval_min']
+        else:
+            self.watch_interval_min = 15
+
+        if 'watch_interval_max' in kwargs.keys():
+            self.watch_interval_max = kwargs['watch_interval_max']
+        else:
+            self.watch_interval_max = 120
+
+        # gives up watching after this many seconds
+        if 'watch_timeout' in kwargs.keys():
+            self.watch_timeout = kwargs['watch_timeout']
+        else:
+            self.watch_timeout = 4 * 60 * 60
         
         self.landing_page_json = "supporting_files/landing_pages.json"
         # get landing pages from landing_pages.json
@@ -45,6 +263,7 @@ class SourceData:
             email = 'cmd@ons.gov.uk' # generic cmd email
 
         self.user_agent = {"User-Agent": f"cmd-run-transforms/Version1.0.0 ONS {email}"}
+        self.cache = HttpCache("landing-pages")
 
     def get_source_files(self):
         if self.dataset not in self.page_details.keys():
@@ -55,91 +274,136 @@ class SourceData:
         assert self.dataset in self.page_details.keys(), f"{self.dataset} is not in {self.landing_page_json}, landing page is unknown"
         
         self.landing_pages = self.page_details[self.dataset]["pages"]
+        # optional glob patterns of the files needed from a zip, all files if not given
+        self.members = self.page_details[self.dataset].get("members")
+
+        if self.watch_release and not self.ignore_release_date:
+            self.wait_for_release()
         
-        for page in self.landing_pages:
-            self._download(page)
+        # files are kept in the order of the landing pages
+        with ThreadPoolExecutor(max_workers=len(self.landing_pages)) as executor:
+            for page_files in executor.map(self._download, self.landing_pages):
+                self.downloaded_files.extend(page_files)
 
         return self.downloaded_files
         
     def _download(self, page):
-        results = self._check_release_date(page)
-        
-        # get link
-        elements = results.find_all("div", class_="inline-block--md margin-bottom-sm--1")
+        # downloads the source file(s) from a landing page, returns list of files
+        downloaded_files = []
+        links = self._check_release_date(page)['links']
 
         if self.weekly_deaths:
+            # currently downloading 2025 & 2024 
+            # increase range to add another year
+            source_files = []
+            download_links = []
             for i in range(2):
-                # currently downloading 2025 & 2024 
-                # increase range to add another year
-                
-                element = elements[i]
-                link = str(element).split("href=")[-1].split(">")[0].strip('"')
-                download_link = f"{self.ons_landing_page}{link}"
+                download_link = f"{self.ons_landing_page}{links[i]['href']}"
+                download_links.append(download_link)
+                source_files.append(download_link.split('/')[-1])
                 
-                # download the file
-                source_file = download_link.split('/')[-1]
-                r = requests.get(download_link, headers=self.user_agent, verify=verify)
-                with open(source_file, 'wb') as output:
-                    output.write(r.content)
-                output.close()
-                
-                print(f"written {source_file}")
-                self.downloaded_files.append(source_file)
+            # download the files together
+            with ThreadPoolExecutor(max_workers=len(download_links)) as executor:
+                list(executor.map(download_file, download_links, source_files, [self.user_agent] * len(download_links)))
+            downloaded_files.extend(source_files)
         
         else:
-            element = elements[0] # latest comes first
-            link = str(element).split("href=")[-1].split(">")[0].strip('"')
-            download_link = f"{self.ons_landing_page}{link}"
+            download_link = f"{self.ons_landing_page}{links[0]['href']}" # latest comes first
             
             # download the file
             source_file = download_link.split('/')[-1]
-            r = requests.get(download_link, headers=self.user_agent, verify=verify)
-            with open(source_file, 'wb') as output:
-                output.write(r.content)
-            print(f"written {source_file}")
-                
-            # unzip if needed
             if source_file.endswith(".zip"):
-                with zipfile.ZipFile(source_file, 'r') as zip_ref:
-                    extracted_file = zip_ref.namelist()
-                    self.downloaded_files.append(extracted_file[0])
-                    zip_ref.extractall("")
-                os.remove(source_file)
-                print(f"extracted {source_file}")
+                # only the members needed are extracted, the zip itself is not kept
+                downloaded_files.extend(download_and_extract(download_link, self.user_agent, members=self.members))
             else:
-                self.downloaded_files.append(source_file)
+                download_file(download_link, source_file, self.user_agent)
+                downloaded_files.append(source_file)
 
-    def _get_results(self, page):
-        landing_page = f"{self.ons_landing_page}{page}"
-        r = requests.get(landing_page, headers=self.user_agent, verify=verify)
-        if r.status_code != 200:
-            raise Exception(f"{self.ons_landing_page}{page} returned a {r.status_code} error")
-        
-        soup = BeautifulSoup(r.content, "html.parser")
-        
-        results = soup.find(id="main")
-        return results
+        return downloaded_files
+
+    def wait_for_release(self):
+        """
+        Polls the landing pages until they all show todays release date
+        Each poll revalidates the page with ons (ETag/Last-Modified), so polling a page
+        that has not changed is cheap
+        The wait between polls grows while the pages are unchanged, up to watch_interval_max,
+        and is jittered so that datasets released together do not all poll at once
+        """
+        pending_pages = list(self.landing_pages)
+        interval = self.watch_interval_min
+        start = time.time()
+        print(f"{self.dataset} - watching {len(pending_pages)} landing page(s) for todays release")
+
+        while True:
+            pending_pages = [
+                page for page in pending_pages 
+                if self._get_page_details(page, revalidate=True)['release_date'] != self.todays_date
+                ]
+            if not pending_pages:
+                print(f"{self.dataset} - released, waited {time.time() - start:.0f} seconds")
+                return
+
+            if time.time() - start > self.watch_timeout:
+                raise Exception(f"{self.dataset} - not released after watching for {self.watch_timeout} seconds, {pending_pages} still not updated")
+
+            wait = interval * random.uniform(0.8, 1.2)
+            print(f"{self.dataset} - not released yet, checking again in {wait:.0f} seconds")
+            time.sleep(wait)
+            interval = min(interval * 1.5, self.watch_interval_max)
+
+    def _get_page_details(self, page, **kwargs):
+        # release date & download links of a landing page, see get_landing_page
+        return get_landing_page(self.cache, f"{self.ons_landing_page}{page}", self.user_agent, **kwargs)
     
     def _check_release_date(self, page):
-        # very hacky but works
-        # check release date
-        results = self._get_results(page)
-        elements = results.find_all("li", class_="col col--md-12 col--lg-15 meta__item")
-        element = str(elements[1])
-        release_date = element.split(">")[-3].split("<")[0]
+        # check release date, returns the page details
+        page_details = self._get_page_details(page)
         
         if self.ignore_release_date:
             # ignores release date if flag is passed
-            return results
+            return page_details
 
-        if release_date == self.todays_date:
-            return results
+        if page_details['release_date'] == self.todays_date:
+            return page_details
         else:
-            results = self._get_results(f"{page}/?123") # in case it is a caching issue
-            # check release date again
-            elements = results.find_all("li", class_="col col--md-12 col--lg-15 meta__item")
-            element = str(elements[1])
-            release_date = element.split(">")[-3].split("<")[0]
-            assert release_date == self.todays_date, f"Release date does not match todays date, aborting source file download"
-            return results
-        
\ No newline at end of file
+            # in case it is a caching issue, the page is checked with ons again
+            page_details = self._get_page_details(f"{page}/?123", revalidate=True)
+            assert page_details['release_date'] == self.todays_date, "Release date does not match todays date, aborting source file download"
+            return page_details
+        
+
+
+class DownloadManager:
+    """
+    Client responsible for downloading the source files of several datasets at once
+    sources is a dict of dataset -> SourceData (or AsheSourceData)
+    Every landing page for every dataset is fetched and parsed concurrently, the number of
+    requests to a single host is limited by host_limit
+    start() returns straight away so downloads can run alongside other work, result(dataset)
+    waits for that dataset's source files only
+    """
+    def __init__(self, sources, **kwargs):
+        assert type(sources) == dict, f"DownloadManager sources must be a dict, got '{type(sources)}'"
+        self.sources = sources
+        self.futures = {}
+        self.executor = None
+
+    def start(self):
+        if self.sources:
+            self.executor = ThreadPoolExecutor(max_workers=len(self.sources))
+        for dataset in self.sources:
+            print(f"downloading source files for {dataset}")
+            self.futures[dataset] = self.executor.submit(self.sources[dataset].get_source_files)
+        return self
+
+    def result(self, dataset):
+        # waits for and returns the source files of a single dataset
+        return self.futures[dataset].result()
+
+    def wait_all(self):
+        # waits for every download to finish, successful or not
+        wait(self.futures.values())
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown()
@@ -0,0 +1,50 @@
+import sys, importlib, importlib.abc, importlib.util
+
+class SourceLoader(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    """
+    Imports modules from source code held in memory, nothing is written to disk
+    Used to run transforms and their requirement modules, which import each other by name
+    sources is a dict of module name -> (source code, origin), origin is where the source
+    came from (url or path) and is shown in tracebacks
+    Used as a context manager, the modules can only be imported inside the with block and
+    are removed from sys.modules when it exits
+
+    with SourceLoader(sources) as loader:
+        transform = loader.import_module("transform_script").transform
+    """
+    def __init__(self, sources):
+        assert type(sources) == dict, f"sources must be a dict, got '{type(sources)}'"
+        self.sources = sources
+
+    def __enter__(self):
+        # checked before the normal import system so stale .py files cannot be picked up
+        sys.meta_path.insert(0, self)
+        return self
+
+    def __exit__(self, *args):
+        sys.meta_path.remove(self)
+        for name in self.sources:
+            sys.modules.pop(name, None)
+
+    def import_module(self, name):
+        assert name in self.sources, f"{name} is not one of the loaded sources {list(self.sources)}"
+        return importlib.import_module(name)
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname not in self.sources:
+            return None
+        source, origin = self.sources[fullname]
+        return importlib.util.spec_from_loader(fullname, self, origin=origin)
+
+    def create_module(self, spec):
+        # default module creation
+        return None
+
+    def exec_module(self, module):
+        source, origin = self.sources[module.__name__]
+        code = compile(source, origin, "exec")
+        exec(code, module.__dict__)
+
+    def get_source(self, fullname):
+        # lets tracebacks show the lines of in memory modules
+        return self.sources[fullname][0]
@@ -1,10 +1,17 @@
-import requests, os, glob, sys
+import os, glob, shutil, tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
-from get_platform import verify
+from source_loader import SourceLoader
+from http_cache import HttpCache, cache_dir
+from v4_sidecar import write_v4_sidecar
 
 # TRANSFORM_URL = "https://raw.github.com/ONS-OpenData/cmd-transforms/master" # old url
 TRANSFORM_URL = "https://raw.githubusercontent.com/ONS-OpenData/cmd-transforms/refs/heads/master"
 
+# name the transform is imported as
+transform_module = "transform_script"
+
 list_of_transforms = [
     "construction", "cpih", "gdp-to-4dp", "house-prices", "index-private-housing-rental-prices", 
     "labour-market-cdid", "lms", "mid-year-pop-est", "online-jobs", "regional-gdp", "retail-sales",
@@ -12,16 +19,109 @@ list_of_transforms = [
     "weekly-deaths-previous", "weekly-deaths", "wellbeing-estimates", "wellbeing-quarterly"
 ]
 
+def get_local_source_files():
+    # gathers all files in the current directory that could be source files
+    source_files = glob.glob("*")
+    source_files = [file for file in source_files if not os.path.isdir(file)] # ignoring any directories
+    source_files = [file for file in source_files if '.py' not in file] # ignoring py files
+    source_files = [file for file in source_files if '__' not in file] # ignoring pycache
+    source_files = [file for file in source_files if '.json' not in file] # ignoring json
+    source_files = [file for file in source_files if '.md' not in file] # ignoring README 
+    source_files = [file for file in source_files if not file.endswith('.part')] # ignoring unfinished downloads
+    return source_files
+
+def get_module_sources(transform_source, transform_origin, requirements_dict):
+    # creates the sources for SourceLoader, requirement modules are imported by the 
+    # transform with '-' replaced by '_'
+    sources = {transform_module: (transform_source, transform_origin)}
+    for module in requirements_dict:
+        sources[module.replace("-", "_")] = requirements_dict[module]
+    return sources
+
+def fetch_transform_sources(cache, dataset, transform_url, requirements_url, modules_url, **kwargs):
+    """
+    Fetches the transform script, its requirements.txt and every module it requires
+    concurrently, with at most fetch_workers requests at once
+    Modules are fetched from {modules_url}/{module}/module.py once requirements.txt is in
+    Returns (transform script, requirements_dict of module -> (script, url))
+    If any fetch fails no more are started and one error listing every failure is raised
+    """
+    if 'fetch_workers' in kwargs.keys():
+        fetch_workers = kwargs['fetch_workers']
+    else:
+        fetch_workers = 8
+
+    def fetch(url):
+        r = cache.get(url)
+        if r['status_code'] == 404 and url == transform_url:
+            raise Exception(f"{url} raised a 404 error, does the transform exist for '{dataset}' on github")
+        elif r['status_code'] != 200 and url == requirements_url:
+            return "" # no requirements needed
+        elif r['status_code'] != 200:
+            raise Exception(f"{url} raised a {r['status_code']} error")
+        return r['content'].decode("utf-8")
+
+    errors = []
+    transform_source = None
+    requirements_dict = {}
+    with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+        transform_future = executor.submit(fetch, transform_url)
+        requirements_future = executor.submit(fetch, requirements_url)
+
+        futures = {transform_future: None} # future -> module, None for the transform
+        try:
+            requirements = requirements_future.result().strip()
+        except Exception as e:
+            errors.append(str(e))
+            requirements = ""
+
+        if requirements and not (transform_future.done() and transform_future.exception()):
+            for module in requirements.split("\n"):
+                futures[executor.submit(fetch, f"{modules_url}/{module}/module.py")] = module
+
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                result = future.result()
+            except Exception as e:
+                errors.append(str(e))
+                # fail fast, do not start anything still waiting
+                for other_future in futures:
+                    other_future.cancel()
+                continue
+            if futures[future] is None:
+                transform_source = result
+            else:
+                requirements_dict[futures[future]] = (result, f"{modules_url}/{futures[future]}/module.py")
+
+    if errors:
+        raise Exception(f"Failed to fetch transform for '{dataset}' from {transform_url}: {errors}")
+
+    return transform_source, requirements_dict
+
 class Transform:
     """
     Client used to run cmd transforms
     Picks up all files (some exceptions) within base directory - can specify source files directly
     if required
-    Picks up the transform from TRANSFORM_URL, writes the file as a .py, runs the transform
-    using the source files, then deletes the transform .py file
+    Picks up the transform from TRANSFORM_URL, imports it from memory (nothing is written
+    to disk) and runs the transform using the source files
+    Scripts are cached locally and revalidated each run, offline=True uses the cached
+    scripts without making any requests
     """
     def __init__(self, dataset, **kwargs):
         self.dataset = dataset
+
+        if 'offline' in kwargs.keys():
+            self.offline = kwargs['offline']
+        else:
+            self.offline = False
+
+        if 'cache_dir' in kwargs.keys():
+            self.cache = HttpCache("transforms", offline=self.offline, cache_dir=kwargs['cache_dir'])
+        else:
+            self.cache = HttpCache("transforms", offline=self.offline)
         
         if 'source_files' in kwargs.keys() and kwargs['source_files'] != '':
             source_files = kwargs['source_files']
@@ -31,106 +131,56 @@ class Transform:
         else:
             # if no source files provided, will gather all files in directory that
             # are not .py files
-            source_files = glob.glob("*")
-            source_files = [file for file in source_files if not os.path.isdir(file)] # ignoring any directories
-            source_files = [file for file in source_files if '.py' not in file] # ignoring py files
-            source_files = [file for file in source_files if '__' not in file] # ignoring pycache
-            source_files = [file for file in source_files if '.json' not in file] # ignoring json
-            source_files = [file for file in source_files if '.md' not in file] # ignoring README 
+            source_files = get_local_source_files()
         self.source_files = source_files
         
         self.transform_url = f"{TRANSFORM_URL}/{self.dataset}/main.py"
         self.requirements_url = f"{TRANSFORM_URL}/{self.dataset}/requirements.txt"
-        self.transform_script = "temp_transform_script.py"
-        self.requirements_dict = {} # will be empty if no requirements needed
+        self.requirements_dict = {} # will be empty if no requirements needed, module -> (script, origin)
         
         
-    def _write_transform(self):
-        # getting transform script
-        r = requests.get(self.transform_url, verify=verify)
-        if r.status_code == 404:
-            raise Exception(f"{self.transform_url} raised a 404 error, does the transform exist for '{self.dataset}' on github")
-        elif r.status_code != 200:
-            raise Exception(f"{self.transform_url} raised a {r.status_code} error")
-        
-        # writing transform script
-        script = r.text
-        with open(self.transform_script, "w") as f:
-            f.write(script)
-            f.close()
-            print(f"transform script wrote as {self.transform_script}")
-                 
-        # getting any requirements
-        r = requests.get(self.requirements_url, verify=verify)
-        if r.status_code == 200:
-            requirements = r.text
-            requirements = requirements.strip().split("\n")
-    
-            for module in requirements:
-                module_url = f"{TRANSFORM_URL}/modules/{module}/module.py"
-                module_r = requests.get(module_url, verify=verify)
-                if module_r.status_code != 200:
-                    raise Exception(f"{module_url} raised a {module_r.status_code} error")
-    
-                module_script = module_r.text
-                self.requirements_dict[module] = module_script
-               
-        # writing any requirements
-        if self.requirements_dict: # if requirements not empty
-            for module in self.requirements_dict:
-                file_name = f"{module}.py".replace("-", "_")
-                module_script = self.requirements_dict[module]
-                with open(file_name, "w") as f:
-                    f.write(module_script)
-                    f.close()
-                print(f"module script wrote as {file_name}")
-                
-    
-    def _del_transform(self):
-        # deletes the written transform and requirements scripts
-        os.remove(self.transform_script)
-        print(f"{self.transform_script} removed")
-        for module in self.requirements_dict:
-            file_name = f"{module}.py".replace("-", "_")
-            os.remove(file_name)
-            print(f"{file_name} removed")
+    def _get_transform(self):
+        # getting transform script and any requirements
+        self.transform_source, self.requirements_dict = fetch_transform_sources(
+            self.cache, self.dataset, self.transform_url, self.requirements_url, f"{TRANSFORM_URL}/modules"
+            )
             
             
     def run_transform(self):
         # runs the transform 
         
-        # write the transform and any requirements
-        self._write_transform()
+        # get the transform and any requirements
+        self._get_transform()
         
-        # import transform
+        # import transform from memory, requirements are importable by name
         print(f"Running transform on: {self.dataset}")
-        from temp_transform_script import transform
-        # catch any errors in the transform
-        try:
-            self.transform_output = transform(self.source_files)
-        except Exception as e:
-            print(f"Error in transform - {self.dataset}")
-            print(e)
-            self._del_transform() # del scripts to avoid hangover
-            raise Exception(e)
-        # del scripts
-        self._del_transform()
-        del sys.modules['temp_transform_script'] # causes issue with multipart transform if not deleted
+        with SourceLoader(get_module_sources(self.transform_source, self.transform_url, self.requirements_dict)) as loader:
+            transform = loader.import_module(transform_module).transform
+            # catch any errors in the transform
+            try:
+                self.transform_output = transform(self.source_files)
+            except Exception as e:
+                print(f"Error in transform - {self.dataset}")
+                print(e)
+                raise Exception(e)
 
 class TransformLocal:
     """
     Client used to run cmd transforms
     Picks up all files (some exceptions) within base directory - can specify source files directly
     if required
-    Picks up the transform locally ({self.path_to_local_transforms}/cmd-transforms), writes the 
-    file as a .py, runs the transform using the source files, then deletes the transform .py file
+    Picks up the transform locally ({self.path_to_local_transforms}/cmd-transforms), imports it
+    from memory and runs the transform using the source files
     
     used to run the transforms that are saved locally
     useful when changes are made to transform
     will only work if the transformed are saved locally
     """
     def __init__(self, dataset, **kwargs):
-        self.path_to_local_transforms = ".."
+        if 'path_to_local_transforms' in kwargs.keys():
+            self.path_to_local_transforms = kwargs['path_to_local_transforms']
+        else:
+            self.path_to_local_transforms = ".."
         
         self.dataset = dataset
         
@@ -142,32 +192,19 @@ class TransformLocal:
         else:
             # if no source files provided, will gather all files in directory that
             # are not .py files
-            source_files = glob.glob("*")
-            source_files = [file for file in source_files if not os.path.isdir(file)] # ignoring any directories
-            source_files = [file for file in source_files if '.py' not in file] # ignoring py files
-            source_files = [file for file in source_files if '__' not in file] # ignoring pycache
-            source_files = [file for file in source_files if '.json' not in file] # ignoring json 
-            source_files = [file for file in source_files if '.md' not in file] # ignoring README
+            source_files = get_local_source_files()
         self.source_files = source_files
         
         self.transform_location = f"{self.path_to_local_transforms}/cmd-transforms/{self.dataset}/main.py"
         self.requirements_location = f"{self.path_to_local_transforms}/cmd-transforms/{self.dataset}/requirements.txt"
-        self.transform_script = "temp_transform_script.py"
-        self.requirements_dict = {} # will be empty if no requirements needed
+        self.requirements_dict = {} # will be empty if no requirements needed, module -> (script, origin)
         
         
-    def _write_transform(self):
+    def _get_transform(self):
         # getting transform script
         with open(self.transform_location, "r") as f: 
-            script = f.read()
+            self.transform_source = f.read()
             f.close()
-        
-        # writing transform script
-        with open(self.transform_script, "w") as f:
-            f.write(script)
-            f.close()
-            print(f"transform script wrote as {self.transform_script}")
-            
             
         # getting any requirements
         if os.path.exists(self.requirements_location):
@@ -183,46 +220,159 @@ class TransformLocal:
             with open(module_location, "r") as f:
                 module_script = f.read()
                 f.close()
-            self.requirements_dict[module] = module_script
-            
-        # writing any requirements
-        if self.requirements_dict: # if requirements not empty
-            for module in self.requirements_dict:
-                file_name = f"{module}.py".replace("-", "_")
-                module_script = self.requirements_dict[module]
-                with open(file_name, "w") as f:
-                    f.write(module_script)
-                    f.close()
-                print(f"module script wrote as {file_name}")
-                
-    
-    def _del_transform(self):
-        # deletes the written transform and requirements scripts
-        os.remove(self.transform_script)
-        print(f"{self.transform_script} removed")
-        for module in self.requirements_dict:
-            file_name = f"{module}.py".replace("-", "_")
-            os.remove(file_name)
-            print(f"{file_name} removed")
+            self.requirements_dict[module] = (module_script, module_location)
             
             
     def run_transform(self):
         # runs the transform 
         
-        # write the transform and any requirements
-        self._write_transform()
+        # get the transform and any requirements
+        self._get_transform()
         
-        # import transform
+        # import transform from memory, requirements are importable by name
         print(f"Running transform on: {self.dataset}")
-        from temp_transform_script import transform
-        # catch any errors in the transform
+        with SourceLoader(get_module_sources(self.transform_source, self.transform_location, self.requirements_dict)) as loader:
+            transform = loader.import_module(transform_module).transform
+            # catch any errors in the transform
+            try:
+                self.transform_output = transform(self.source_files)
+            except Exception as e:
+                print(f"Error in transform - {self.dataset}")
+                print(e)
+                raise Exception(e)
+
+def _run_transform_in_process(dataset, source_files, work_dir, run_locally, path_to_local_transforms, offline, sidecar):
+    """
+    Runs a single transform inside a worker process of TransformPool
+    work_dir is used as the working directory so the transform's outputs do not clash
+    with any other transform running at the same time
+    With sidecar a parquet copy of each v4 is written alongside it, in the worker
+    """
+    cwd = os.getcwd()
+    # the transform cache lives in the main working directory
+    cache = os.path.abspath(cache_dir)
+    os.chdir(work_dir)
+    try:
+        if run_locally:
+            transform = TransformLocal(dataset, source_files=source_files, path_to_local_transforms=path_to_local_transforms)
+        else:
+            transform = Transform(dataset, source_files=source_files, offline=offline, cache_dir=cache)
+        transform.run_transform()
+        if sidecar:
+            for v4_file in transform.transform_output.values():
+                write_v4_sidecar(v4_file)
+        return transform.transform_output
+
+    finally:
+        os.chdir(cwd)
+
+class TransformPool:
+    """
+    Client used to run cmd transforms in parallel, each in its own worker process
+    Each transform runs in its own temporary working directory, source files are linked
+    into it and any files the transform writes are moved back into the current directory
+    once it has finished
+    """
+    def __init__(self, **kwargs):
+        if 'processes' in kwargs.keys():
+            self.processes = kwargs['processes']
+        else:
+            self.processes = os.cpu_count()
+
+        if 'run_locally' in kwargs.keys():
+            self.run_locally = kwargs['run_locally']
+        else:
+            self.run_locally = False
+
+        if 'offline' in kwargs.keys():
+            self.offline = kwargs['offline']
+        else:
+            self.offline = False
+
+        # writes a parquet sidecar of each v4, see v4_sidecar
+        if 'sidecar' in kwargs.keys():
+            self.sidecar = kwargs['sidecar']
+        else:
+            self.sidecar = False
+
+        # local transforms are found relative to the current directory, not the work_dir
+        self.path_to_local_transforms = os.path.abspath("..")
+
+        # spawn so workers are not forked from a process running other threads
+        self.executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("spawn"))
+
+    def run(self, dataset, source_files):
+        """
+        Runs the transform for a dataset, blocks until it is complete
+        Can be called from several threads at once
+        Returns the transform_output
+        """
+        if not source_files:
+            source_files = get_local_source_files()
+        # source files must be a list for consistency
+        if type(source_files) == str:
+            source_files = [source_files]
+
+        work_dir = tempfile.mkdtemp(prefix=f".transform-{dataset}-", dir=os.getcwd())
         try:
-            self.transform_output = transform(self.source_files)
-        except Exception as e:
-            print(f"Error in transform - {self.dataset}")
-            print(e)
-            self._del_transform() # del scripts to avoid hangover
-            raise Exception(e)
-        # del scripts
-        self._del_transform()
-        del sys.modules['temp_transform_script'] # causes issue with multipart transform if not deleted
+            source_files, linked_files = self._link_source_files(source_files, work_dir)
+            future = self.executor.submit(
+                _run_transform_in_process, dataset, source_files, work_dir, 
+                self.run_locally, self.path_to_local_transforms, self.offline, self.sidecar
+                )
+            transform_output = future.result()
+            self._gather_outputs(work_dir, linked_files)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        # outputs are now in the current directory
+        for key in transform_output:
+            if os.path.isabs(transform_output[key]) and transform_output[key].startswith(work_dir):
+                transform_output[key] = os.path.relpath(transform_output[key], work_dir)
+        return transform_output
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+    def _link_source_files(self, source_files, work_dir):
+        # makes source files available in work_dir under the same relative names
+        # files whose relative name would be outside work_dir (i.e. '../file') are linked in
+        # by their file name only, so nothing is ever linked outside work_dir
+        # hard links are used where possible so nothing is copied
+        # returns the source files as the transform should be given them & the linked files
+        transform_source_files = []
+        linked_files = {} # name in work_dir -> source file
+        for file in source_files:
+            if os.path.isabs(file):
+                # read where it is
+                transform_source_files.append(file)
+                continue
+            linked_name = os.path.normpath(file)
+            if os.path.commonpath([os.path.abspath(os.path.join(work_dir, linked_name)), work_dir]) != work_dir:
+                linked_name = os.path.basename(linked_name)
+            if linked_name in ("", ".", ".."):
+                raise Exception(f"source file {file} cannot be linked into the transform's working directory")
+            transform_source_files.append(linked_name)
+            if linked_name in linked_files:
+                if os.path.abspath(linked_files[linked_name]) != os.path.abspath(file):
+                    raise Exception(f"source files {linked_files[linked_name]} and {file} would both be linked as {linked_name}")
+                continue
+            linked_file = os.path.join(work_dir, linked_name)
+            os.makedirs(os.path.dirname(linked_file), exist_ok=True)
+            try:
+                os.link(file, linked_file)
+            except OSError:
+                shutil.copy2(file, linked_file)
+            linked_files[linked_name] = file
+        return transform_source_files, set(linked_files)
+
+    def _gather_outputs(self, work_dir, linked_files):
+        # moves everything the transform wrote back into the current directory
+        for root, dirs, files in os.walk(work_dir):
+            for file in files:
+                output_file = os.path.relpath(os.path.join(root, file), work_dir)
+                if os.path.normpath(output_file) in linked_files:
+                    continue
+                if os.path.dirname(output_file):
+                    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+                shutil.move(os.path.join(root, file), output_file)
@@ -1,17 +1,33 @@
-import os, datetime, time
+import os, datetime, time, requests, json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from clients.base_client import Base
 
+chunk_size = 5 * 1024 * 1024 # standard, bytes of v4 posted in each chunk
+
 class UploadClient(Base):
     """
     Uses Base as a parent client
     Client responsible for uploading v4 to the upload api
-    Chunks a v4 into correct sized chunks, posts one chunk at a time to api, then
-    deletes all chunks
+    Splits a v4 into correct sized chunks, posts the chunks to the api concurrently 
+    (upload_workers at a time)
+    Chunks are read straight from the v4 by each worker, nothing is written to disk
+    Acknowledged chunks are recorded in a checkpoint file next to the v4 so that a failed
+    upload can be rerun and will carry on from the chunks that were not posted
     """
     def __init__(self, upload_dict, **kwargs):
         Base.__init__(self, **kwargs)
         self._assign(upload_dict)
+
+        if 'upload_workers' in kwargs.keys():
+            self.upload_workers = kwargs['upload_workers']
+        else:
+            self.upload_workers = 4
+
+        if 'chunk_retries' in kwargs.keys():
+            self.chunk_retries = kwargs['chunk_retries']
+        else:
+            self.chunk_retries = 3
         
 
     def post_v4_to_s3(self):
@@ -25,76 +41,167 @@ class UploadClient(Base):
     def _post_single_v4_to_s3(self, v4):
         # properties that do not change for the upload
         csv_total_size = str(os.path.getsize(v4)) # size of the whole csv
-        timestamp = datetime.datetime.now() # to be ued as unique resumableIdentifier
-        timestamp = datetime.datetime.strftime(timestamp, "%d%m%y%H%M%S")
         file_name = v4.split("/")[-1]
 
         # chunk up the data
-        temp_files = self._create_temp_chunks(v4) # list of temporary files
-        total_number_of_chunks = len(temp_files)
-        chunk_number = 1 # starting chunk number
-
-        # uploading each chunk
-        for chunk_file in temp_files:
-            csv_size = str(os.path.getsize(chunk_file)) # size of the chunk
-
-            with open(chunk_file, "rb") as f:
-                files = {"file": f} # Inlcude the opened file in the request
-                
-                # Params that are added to the request
+        chunks = self._get_chunk_ranges(v4) # list of (offset, size)
+        total_number_of_chunks = len(chunks)
+
+        # carry on from a previous failed upload of the same file if there is one
+        checkpoint = self._load_checkpoint(v4)
+        if checkpoint:
+            resumable_identifier = checkpoint['resumable_identifier']
+            print(f"Resuming upload of {file_name} - {len(checkpoint['acknowledged_chunks'])} of {total_number_of_chunks} chunks already posted")
+        else:
+            timestamp = datetime.datetime.now() # to be ued as unique resumableIdentifier
+            timestamp = datetime.datetime.strftime(timestamp, "%d%m%y%H%M%S")
+            resumable_identifier = f"{timestamp}-{file_name.replace('.', '')}"
+            checkpoint = self._create_checkpoint(v4, resumable_identifier)
+
+        # uploading the chunks concurrently, chunk numbers start at 1
+        upload_start = time.time()
+        uploaded_bytes = 0
+        with ThreadPoolExecutor(max_workers=self.upload_workers) as executor:
+            futures = []
+            for chunk_number, (offset, size) in enumerate(chunks, start=1):
+                if chunk_number in checkpoint['acknowledged_chunks']:
+                    continue
                 params = {
                         "resumableType": "text/csv",
                         "resumableChunkNumber": chunk_number,
-                        "resumableCurrentChunkSize": csv_size,
+                        "resumableCurrentChunkSize": str(size),
                         "resumableTotalSize": csv_total_size,
-                        "resumableChunkSize": csv_size,
-                        "resumableIdentifier": f"{timestamp}-{file_name.replace('.', '')}",
+                        "resumableChunkSize": str(size),
+                        "resumableIdentifier": resumable_identifier,
                         "resumableFilename": file_name,
                         "resumableRelativePath": ".",
                         "resumableTotalChunks": total_number_of_chunks
                 }
-                
-                # making the POST request
-                response = self.http_request('post', self.upload_url, params=params, files=files)
-                if response['status_code'] != 200:  
-                    raise Exception(f"{self.upload_url} returned error {response['status_code']}")
-                    
-                print(f"tmp file number - {chunk_number} posted")
-                chunk_number += 1 # moving onto next chunk number
+                futures.append(executor.submit(self._post_chunk, v4, offset, size, params))
+                uploaded_bytes += size
+
+            # record every chunk that does get posted, even if others fail
+            errors = []
+            for future in as_completed(futures):
+                try:
+                    chunk_number = future.result()
+                except Exception as e:
+                    errors.append(str(e))
+                    continue
+                checkpoint['acknowledged_chunks'].append(chunk_number)
+                self._write_checkpoint(v4, checkpoint)
+                print(f"chunk number - {chunk_number} of {total_number_of_chunks} posted")
+
+        if errors:
+            raise Exception(f"Upload of {file_name} failed, rerun to resume from checkpoint - {errors}")
+
+        upload_time = time.time() - upload_start
+        megabytes = uploaded_bytes / (1024 * 1024)
+        print(f"Uploaded {megabytes:.1f} MB in {upload_time:.1f} seconds ({megabytes / max(upload_time, 0.001):.2f} MB/s)")
 
-        s3_key = params["resumableIdentifier"]
+        s3_key = resumable_identifier
         s3_url = f"https://s3-eu-west-2.amazonaws.com/ons-dp-prod-publishing-uploaded-datasets/{s3_key}"
     
-        # delete temp files & tmp v4
-        self._delete_temp_chunks(temp_files)
+        # upload is complete so checkpoint is no longer needed
+        os.remove(self._checkpoint_path(v4))
         print("Upload to s3 complete")
         
         return s3_url
 
-    def _create_temp_chunks(self, v4):
+    def _post_chunk(self, v4, offset, size, params):
         """
-        Chunks up the data into text files, returns list of temp files
+        Reads a single chunk from the v4 and posts it, retrying up to self.chunk_retries times
+        Only this chunk is held in memory
+        Returns the chunk number once posted
+        """
+        chunk_number = params["resumableChunkNumber"]
+        chunk = self._read_chunk(v4, offset, size)
+        # named as the old temp chunk files were so the request is unchanged
+        files = {"file": (f"temp-file-part-{chunk_number}", chunk)}
+        for attempt in range(1, self.chunk_retries + 1):
+            try:
+                response = self.http_request('post', self.upload_url, params=params, files=files)
+                if response['status_code'] == 200:
+                    return chunk_number
+                error = f"{self.upload_url} returned error {response['status_code']}"
+            except requests.exceptions.RequestException as e:
+                error = f"{self.upload_url} raised {e}"
+
+            if attempt < self.chunk_retries:
+                print(f"chunk {chunk_number} failed on attempt {attempt} - {error}, retrying")
+                time.sleep(2 ** attempt)
+
+        raise Exception(f"chunk {chunk_number} failed after {self.chunk_retries} attempts - {error}")
+
+    def _get_chunk_ranges(self, v4):
+        """
+        Splits the v4 into chunks, returns list of (offset, size) for each chunk
+        """
+        total_size = os.path.getsize(v4)
+        return [
+            (offset, min(chunk_size, total_size - offset)) 
+            for offset in range(0, total_size, chunk_size)
+            ]
+
+    def _read_chunk(self, v4, offset, size):
+        """
+        Reads size bytes of the v4 starting at offset
+        """
+        with open(v4, 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def _checkpoint_path(self, v4):
+        """
+        Checkpoint is kept next to the v4 as a hidden file
         """
-        chunk_size = 5 * 1024 * 1024 #standard
-        file_number = 1
         location = "/".join(v4.split("/")[:-1]) + "/"
         if location == "/": 
             location = ""
-        temp_files = []
-        with open(v4, 'rb') as f:
-            chunk = f.read(chunk_size)
-            while chunk:
-                file_name = f"{location}temp-file-part-{str(file_number)}"
-                with open(file_name, 'wb') as chunk_file:
-                    chunk_file.write(chunk)
-                    temp_files.append(file_name)
-                file_number += 1
-                chunk = f.read(chunk_size)
-        return temp_files 
-
-    def _delete_temp_chunks(self, temporary_files: list):
+        file_name = v4.split("/")[-1]
+        return f"{location}.{file_name}.upload-checkpoint.json"
+
+    def _file_details(self, v4):
         """
-        Deletes the temporary chunks that were uploaded
+        Returns size & modified time of the v4 and the chunk size, used to check a
+        checkpoint belongs to this file as it is now
         """
-        for file in temporary_files:
-            os.remove(file)
+        return {
+            'file_size': os.path.getsize(v4),
+            'mtime': os.path.getmtime(v4),
+            'chunk_size': chunk_size
+            }
+
+    def _create_checkpoint(self, v4, resumable_identifier):
+        checkpoint = self._file_details(v4)
+        checkpoint['resumable_identifier'] = resumable_identifier
+        checkpoint['acknowledged_chunks'] = []
+        self._write_checkpoint(v4, checkpoint)
+        return checkpoint
+
+    def _load_checkpoint(self, v4):
+        """
+        Returns the checkpoint of a previous upload of v4
+        Returns None if there is no checkpoint or the v4 has changed since
+        """
+        checkpoint_path = self._checkpoint_path(v4)
+        if not os.path.exists(checkpoint_path):
+            return None
+
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+
+        file_details = self._file_details(v4)
+        for key in file_details:
+            if checkpoint[key] != file_details[key]:
+                print(f"Ignoring checkpoint {checkpoint_path}, v4 has changed")
+                return None
+
+        return checkpoint
+
+    def _write_checkpoint(self, v4, checkpoint):
+        # written to a temp file first so a crash cannot leave a half written checkpoint
+        checkpoint_path = self._checkpoint_path(v4)
+        with open(f"{checkpoint_path}.tmp", "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
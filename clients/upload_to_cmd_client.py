@@ -13,6 +13,8 @@ class UploadToCmd(
     Uses CollectionClient, RecipeClient, DatasetClient, UploadClient as parent classes
     Client is responsible for running the full upload process, from taking a v4 all the way to 
     adding it to a collection ready to be published
+    Imports are monitored together and each dataset moves on to its collection as soon
+    as its own import is complete
     Can run a partial upload where it stops after monitoring the v4 has been uploaded into 
     CMD, this is useful when uploading a new dataset as the process is slightly different after this point
     Can also run adding a dataset to a collection, useful for very large datasets that have been left to
@@ -32,6 +34,21 @@ class UploadToCmd(
         DatasetClient.__init__(self, upload_dict, **kwargs)
         UploadClient.__init__(self, upload_dict, **kwargs)
     
+    def _complete_single_upload(self, dataset_id):
+        # runs the steps that follow a completed import for a single dataset
+        
+        # create new collection
+        self._create_single_collection(dataset_id)
+        
+        # updating instance
+        self._update_single_instance(dataset_id)
+            
+        # adding data to collection
+        self._add_single_to_collection(dataset_id)
+        
+        # adding final metadata
+        self._add_single_metadata(dataset_id)
+    
     def run_upload(self):
         # runs the full upload 
         
@@ -44,20 +61,9 @@ class UploadToCmd(
         # start upload into CMD
         self.post_new_job()
         
-        # monitoring upload
-        self.monitor_upload()
-        
-        # create new collection
-        self.create_collection()
-        
-        # updating instance
-        self.updating_instance()
-            
-        # adding data to collection
-        self.add_to_collection()
-        
-        # adding final metadata
-        self.adding_metadata()
+        # monitoring upload, each dataset is added to a collection as soon 
+        # as its own import is complete
+        self.monitor_upload(on_complete=self._complete_single_upload)
 
     def run_partial_upload(self):
         # runs a partial upload, stops after v4 is loaded into Florence and instance is complete
@@ -84,17 +90,6 @@ class UploadToCmd(
         
         self.get_instance_id(ignore_upload_date=ignore_upload_date)
         
-        # monitoring upload
-        self.monitor_upload()
-        
-        # create new collection
-        self.create_collection()
-        
-        # updating instance
-        self.updating_instance()
-            
-        # adding data to collection
-        self.add_to_collection()
-        
-        # adding final metadata
-        self.adding_metadata()
\ No newline at end of file
+        # monitoring upload, each dataset is added to a collection as soon 
+        # as its own import is complete
+        self.monitor_upload(on_complete=self._complete_single_upload)
\ No newline at end of file
@@ -1,23 +1,65 @@
-import requests, os, math
+import os
+import numpy as np
 import pandas as pd
 
 from base_client import Base
-from get_platform import verify
+from code_list_store import CodeListStore
+from recipe_store import get_recipe_store
+from v4_sidecar import read_v4_header, iter_v4_chunks
+
+# code lists that are not checked against the api
+skipped_codelists = ['countries-and-territories']
+
+# largest number of code combinations checked with a bitmap (1 bit each, 128MB)
+# above this the keys of every row are sorted instead
+max_bitmap_keys = 2**30
+# number of missing or duplicate rows shown when sparsity is found
+rows_to_report = 5
+# stands in for empty codes, which cannot be a category
+missing_code = "<empty>"
+# number of wrong labels shown for each code list
+labels_to_report = 20
 
 class V4Checker(Base):
     """
     Uses Base as a parent class
     CLient responsible for validating v4
-    Checks v4 does not contain any sparisty
+    Checks v4 does not contain any sparisty or duplicate rows
     Checks code lists found in v4 are in the recipe and then checks that the options
     within each code list are found in the code list api
+    Checks the label of each option matches its label in the code list (check_labels)
+    Code lists are kept in a local store (.cmd-cache/code-lists.sqlite) so repeat runs
+    and offline runs do not need to download them
     """
     def __init__(self, transform_outputs, **kwargs):
         # Base as child class to access recipe API
         Base.__init__(self, **kwargs)
         assert type(transform_outputs) == dict, f"V4Checker imput must be a dict, got '{type(transform_outputs)}'"
         self.transform_outputs = transform_outputs
-        self.code_list_api_url = "https://api.beta.ons.gov.uk/v1/code-lists"
+
+        # validates against stored code lists without making any requests
+        if 'offline' in kwargs.keys():
+            self.offline = kwargs['offline']
+        else:
+            self.offline = False
+
+        # seconds a stored code list is used before it is revalidated with the api
+        if 'code_list_ttl' in kwargs.keys():
+            self.code_list_ttl = kwargs['code_list_ttl']
+        else:
+            self.code_list_ttl = 24 * 60 * 60
+
+        # checks the label of every code matches the code list
+        if 'check_labels' in kwargs.keys():
+            self.check_labels = kwargs['check_labels']
+        else:
+            self.check_labels = True
+
+        # rows of the v4 read at once, v4s are never read into memory whole
+        if 'chunk_size' in kwargs.keys():
+            self.chunk_size = kwargs['chunk_size']
+        else:
+            self.chunk_size = 500000
 
         # get user-agent
         email = os.getenv('FLORENCE_EMAIL')
@@ -25,6 +67,7 @@ class V4Checker(Base):
             email = 'cmd@ons.gov.uk' # generic cmd email
 
         self.user_agent = {"User-Agent": f"cmd-run-transforms/Version1.0.0 ONS {email}"}
+        self.code_list_store = CodeListStore(offline=self.offline, ttl=self.code_list_ttl, headers=self.user_agent)
         
     def run_check(self):
         print("---")
@@ -32,31 +75,180 @@ class V4Checker(Base):
             self.dataset_id = dataset_id
             v4_file = self.transform_outputs[dataset_id]
             print(f"Running V4Checker on {self.dataset_id}")
-            self.df = pd.read_csv(v4_file, dtype=str)
+            self._read_v4(v4_file)
             self._check_sparsity()
             self._check_dimensions()
+            if self.check_labels:
+                self._check_labels()
             
             # deleting all specific self.<variables>
-            del self.dataset_id, self.df_codelists, self.recipe_codelists
-            del self.df
+            del self.dataset_id, self.df_codelists, self.df_labels, self.recipe_codelists, self.codes
+            del self.row_count, self.dimension_counts, self.label_counts, self.categories, self.v4_file, self.code_positions
             print("---")
         return
+
+    def _read_v4(self, v4_file):
+        """
+        Reads the code columns of the v4 a chunk at a time, keeping only the number of
+        rows and the number of rows of each distinct code of each dimension
+        If check_labels, label columns are read too and the number of rows of each
+        distinct (code, label) pair is kept
+        Empty codes & labels are counted as missing_code
+        Memory used depends on the number of codes, not the number of rows
+        """
+        df_columns = read_v4_header(v4_file)
+        v4_marker = int(df_columns[0][-1])
+        self.df_codelists = df_columns[v4_marker+1::2] # just code list id columns
+        self.df_labels = df_columns[v4_marker+2::2] # label column follows its code column
+        code_positions = list(range(v4_marker+1, len(df_columns), 2))
+        if self.check_labels:
+            usecols = list(range(v4_marker+1, len(df_columns)))
+        else:
+            usecols = code_positions
+
+        self.v4_file = v4_file
+        self.code_positions = code_positions
+        self.row_count = 0
+        chunk_counts = {col: [] for col in self.df_codelists}
+        # read as categories, each chunk's codes are parsed once and counted by position
+        # read from the parquet sidecar if there is one
+        for chunk in iter_v4_chunks(v4_file, usecols, self.chunk_size):
+            self.row_count += len(chunk)
+            for col, label_col in zip(self.df_codelists, self.df_labels):
+                if self.check_labels:
+                    chunk_counts[col].append(self._count_pairs(chunk[col], chunk[label_col]))
+                else:
+                    counts = chunk[col].value_counts(dropna=False)
+                    counts = counts[counts > 0] # categories can include values not in the chunk
+                    counts.index = counts.index.astype(object).fillna(missing_code)
+                    chunk_counts[col].append(counts)
+
+        # counts of each chunk are combined once at the end
+        self.dimension_counts = {}
+        self.label_counts = {}
+        for col in self.df_codelists:
+            if not chunk_counts[col]:
+                self.dimension_counts[col] = pd.Series(dtype="int64")
+            elif self.check_labels:
+                self.label_counts[col] = pd.concat(chunk_counts[col]).groupby(level=[0, 1]).sum()
+                self.dimension_counts[col] = self.label_counts[col].groupby(level=0).sum()
+            else:
+                self.dimension_counts[col] = pd.concat(chunk_counts[col]).groupby(level=0).sum()
+
+    def _count_pairs(self, codes, labels):
+        # number of rows of each (code, label) pair in a chunk, codes & labels are categorical
+        # each pair's category positions are packed into one int so they can be counted with np.unique
+        # position 0 is an empty code/label
+        code_positions = codes.cat.codes.to_numpy().astype(np.int64) + 1
+        label_positions = labels.cat.codes.to_numpy().astype(np.int64) + 1
+        radix = len(labels.cat.categories) + 1
+        keys, counts = np.unique(code_positions * radix + label_positions, return_counts=True)
+
+        code_values = np.array([missing_code] + list(codes.cat.categories), dtype=object)[keys // radix]
+        label_values = np.array([missing_code] + list(labels.cat.categories), dtype=object)[keys % radix]
+        return pd.Series(counts, index=pd.MultiIndex.from_arrays([code_values, label_values]))
     
     def _check_sparsity(self):
-        # checks sparsity of only the codes (not labels)
-        df_size = len(self.df)
-        
-        df_columns = list(self.df.columns)
-        v4_marker = int(self.df.columns[0][-1])
-        self.df_codelists = df_columns[v4_marker+1::2] # just code list id columns
-        unsparse_length = 1
+        """
+        Checks every combination of codes (not labels) appears exactly once
+        Reads the v4 a second time, each row's codes are turned into their position in
+        their dimension's codes and packed into a single int64 key (mixed radix), so keys
+        are exact and every combination has its own key in 0 to number of combinations
+        Keys are marked off in a bitmap to find duplicates & missing combinations
+        """
+        self.categories = {}
         for col in self.df_codelists:
-            unsparse_length *= self.df[col].unique().size
-            
-        if df_size != unsparse_length:
-            raise Exception(f"Sparsity found aborting... len of df - {df_size}, not equal to unsparse length - {unsparse_length}")
+            self.categories[col] = sorted(self.dimension_counts[col].index)
+
+        # key = sum of position * stride, stride of the last dimension is 1
+        strides = []
+        unsparse_length = 1
+        for col in reversed(self.df_codelists):
+            strides.insert(0, unsparse_length)
+            unsparse_length *= len(self.categories[col])
+
+        if unsparse_length >= 2**63:
+            raise Exception(f"Sparsity found aborting... len of df - {self.row_count}, not equal to unsparse length - {unsparse_length}")
+
+        if unsparse_length <= max_bitmap_keys:
+            duplicate_keys, missing_keys, duplicate_count, missing_count = self._check_keys_with_bitmap(strides, unsparse_length)
+        else:
+            duplicate_keys, missing_keys, duplicate_count, missing_count = self._check_keys_sorted(strides, unsparse_length)
+
+        if duplicate_count or missing_count:
+            message = f"Sparsity found aborting... len of df - {self.row_count}, unsparse length - {unsparse_length}"
+            if duplicate_count:
+                message += f"\n{duplicate_count} duplicate row(s), i.e. {[self._key_to_codes(key, strides) for key in duplicate_keys]}"
+            if missing_count:
+                message += f"\n{missing_count} missing row(s), i.e. {[self._key_to_codes(key, strides) for key in missing_keys]}"
+            raise Exception(message)
             
         print("Dataset sparsity complete")
+
+    def _read_keys(self, strides):
+        # yields the packed key of every row, a chunk at a time
+        for chunk in iter_v4_chunks(self.v4_file, self.code_positions, self.chunk_size):
+            keys = np.zeros(len(chunk), dtype=np.int64)
+            for col, stride in zip(self.df_codelists, strides):
+                # only the chunk's categories are matched up, not every row
+                positions = chunk[col].cat.set_categories(self.categories[col]).cat.codes.to_numpy().astype(np.int64)
+                if missing_code in self.categories[col]:
+                    positions[positions == -1] = self.categories[col].index(missing_code)
+                keys += positions * stride
+            yield keys
+
+    def _check_keys_with_bitmap(self, strides, unsparse_length):
+        seen = np.zeros((unsparse_length + 7) // 8, dtype=np.uint8)
+        duplicate_keys = []
+        duplicate_count = 0
+        for keys in self._read_keys(strides):
+            unique_keys, counts = np.unique(keys, return_counts=True)
+            already_seen = (seen[unique_keys >> 3] >> (unique_keys & 7).astype(np.uint8)) & 1
+            # repeated in this chunk and/or seen in an earlier chunk
+            repeats = counts - 1 + already_seen
+            duplicate_count += int(repeats.sum())
+            if len(duplicate_keys) < rows_to_report:
+                duplicate_keys.extend(unique_keys[repeats > 0][:rows_to_report - len(duplicate_keys)].tolist())
+            np.bitwise_or.at(seen, unique_keys >> 3, (1 << (unique_keys & 7)).astype(np.uint8))
+
+        missing_count = unsparse_length - (self.row_count - duplicate_count)
+        missing_keys = []
+        if missing_count:
+            # first few keys not seen, looked for a block of the bitmap at a time
+            block_size = 2**20
+            for start in range(0, len(seen), block_size):
+                bits = np.unpackbits(seen[start:start + block_size], bitorder="little")
+                block_missing = np.flatnonzero(bits == 0) + start * 8
+                missing_keys.extend(block_missing[block_missing < unsparse_length][:rows_to_report - len(missing_keys)].tolist())
+                if len(missing_keys) >= rows_to_report:
+                    break
+        return duplicate_keys, missing_keys, duplicate_count, missing_count
+
+    def _check_keys_sorted(self, strides, unsparse_length):
+        # too many combinations for a bitmap, every key is kept and sorted
+        unique_keys, counts = np.unique(np.concatenate(list(self._read_keys(strides))), return_counts=True)
+        duplicate_count = int((counts - 1).sum())
+        duplicate_keys = unique_keys[counts > 1][:rows_to_report].tolist()
+
+        missing_count = unsparse_length - len(unique_keys)
+        missing_keys = []
+        if missing_count:
+            # keys are missing wherever consecutive unique keys are not consecutive
+            bounds = np.concatenate([[-1], unique_keys, [unsparse_length]])
+            for gap in np.flatnonzero(np.diff(bounds) > 1)[:rows_to_report].tolist():
+                start, end = int(bounds[gap]) + 1, int(bounds[gap + 1])
+                missing_keys.extend(range(start, min(end, start + rows_to_report - len(missing_keys))))
+                if len(missing_keys) >= rows_to_report:
+                    break
+        return duplicate_keys, missing_keys, duplicate_count, missing_count
+
+    def _key_to_codes(self, key, strides):
+        # unpacks a key back into a dict of code list -> code
+        codes = {}
+        for col, stride in zip(self.df_codelists, strides):
+            position, key = divmod(key, stride)
+            codes[col] = self.categories[col][position]
+        return codes
         
     def _check_dimensions(self):
         # calls _get_dimensions_from_recipe()
@@ -68,58 +260,81 @@ class V4Checker(Base):
             
         for codelist in self.df_codelists:
             assert codelist in self.recipe_codelists, f"code list '{codelist}' not found in recipe"
-            self._check_codelist_against_api(codelist)
+
+        # every code list is got at once, only ones that have changed are fetched
+        self.codes = self.code_list_store.get_many([codelist for codelist in self.df_codelists if codelist not in skipped_codelists])
+
+        # every dimension is checked before raising, so all bad codes are reported together
+        missing_codes = {}
+        for codelist in self.df_codelists:
+            missing = self._check_codelist_against_api(codelist)
+            if missing:
+                missing_codes[codelist] = missing
+
+        if missing_codes:
+            message = f"Codes not found in code list api for {self.dataset_id}"
+            for codelist in missing_codes:
+                codes = ", ".join(f"{code} ({rows} rows)" for code, rows in missing_codes[codelist].items())
+                message += f"\n{codelist} - {len(missing_codes[codelist])} code(s) - {codes}"
+            raise Exception(message)
                 
     def _get_dimensions_from_recipe(self):
-        # gets recipe from recipe api
-        # assigns code list id's to self.recipe_codelists
-        response = self.http_request('get', f"{self.recipe_url}?limit=1000")
-        if response['status_code'] == 200:
-            all_recipes = response['response_dict']
-        else:
-            raise Exception(f"Recipe API returned a {response['status_code']} error")
-        
+        # gets recipes from the shared recipe store
+        # assigns code list id's of every recipe for the dataset to self.recipe_codelists
         self.recipe_codelists = []
-        for item in all_recipes["items"]:
-            # hack around incorrect recipe in database
-            if item['id'] == 'b944be78-f56d-409b-9ebd-ab2b77ffe187':
-                continue
-            if self.dataset_id == item["output_instances"][0]["dataset_id"]:
-                dataset_recipe = item
-                recipe_codelists_list = dataset_recipe['output_instances'][0]['code_lists']
-                for codelist in recipe_codelists_list:
-                    self.recipe_codelists.append(codelist['id'])
+        for dataset_recipe in get_recipe_store().get(self, self.dataset_id):
+            recipe_codelists_list = dataset_recipe['output_instances'][0]['code_lists']
+            for codelist in recipe_codelists_list:
+                self.recipe_codelists.append(codelist['id'])
                     
     def _check_codelist_against_api(self, codelist_id):
         # checks options in a dimension appear in the code list api
         # only checks codes not labels
-        if codelist_id == 'countries-and-territories':
+        # returns dict of code -> number of rows for codes not in the code list
+        if codelist_id in skipped_codelists:
             print(f"Ignoring {codelist_id} code list because of nans")
-            return
+            return {}
             
-        codelist_url = f"{self.code_list_api_url}/{codelist_id}/editions/one-off/codes"
-        codelist_dict = requests.get(codelist_url, headers=self.user_agent, verify=verify).json()
-        total_count = codelist_dict['total_count'] 
-        
-        codes_list = []
-        
-        if total_count <= 1000:
-            new_url = f"{codelist_url}?limit=1000"
-            whole_codelist_dict = requests.get(new_url, headers=self.user_agent, verify=verify).json()
-            for item in whole_codelist_dict['items']:
-                codes_list.append(item['code'])
-                
-        else:
-            number_of_iterations = math.ceil(total_count/1000)
-            offset = 0
-            for i in range(number_of_iterations):
-                new_url = f"{codelist_url}?limit=1000&offset={offset}"
-                whole_codelist_dict = requests.get(new_url, headers=self.user_agent, verify=verify).json()
-                for item in whole_codelist_dict['items']:
-                    codes_list.append(item['code'])
-                offset += 1000
-        
-        for code in self.df[codelist_id].unique():
-            assert code in codes_list, f"{code} does not appear in {codelist_id} code list"
+        dimension_counts = self.dimension_counts[codelist_id]
+        missing = dimension_counts[~dimension_counts.index.isin(list(self.codes[codelist_id]))]
+        if len(missing):
+            print(f"{codelist_id} has {len(missing)} code(s) not in the code list")
+            return missing.sort_values(ascending=False).to_dict()
         
-        print(f"{codelist_id} good")
\ No newline at end of file
+        print(f"{codelist_id} good")
+        return {}
+
+    def _check_labels(self):
+        # checks the label of each code in the v4 matches its label in the code list
+        # codes that are not in the code list are reported by _check_dimensions
+        mismatches = {}
+        for col in self.df_codelists:
+            if col in skipped_codelists:
+                continue
+
+            pair_counts = self.label_counts[col]
+            codes = pd.Series(pair_counts.index.get_level_values(0))
+            labels = pd.Series(pair_counts.index.get_level_values(1))
+            expected_labels = codes.map(self.codes[col])
+
+            wrong = (expected_labels.notna() & (labels.str.strip() != expected_labels.str.strip())).to_numpy()
+            if wrong.any():
+                mismatches[col] = pd.DataFrame({
+                    'code': codes[wrong].to_numpy(), 
+                    'label': labels[wrong].to_numpy(), 
+                    'expected_label': expected_labels[wrong].to_numpy(), 
+                    'rows': pair_counts.to_numpy()[wrong]
+                    })
+            else:
+                print(f"{col} labels good")
+
+        if mismatches:
+            message = f"Labels do not match the code list api for {self.dataset_id}"
+            for col in mismatches:
+                wrong_labels = mismatches[col]
+                message += f"\n{col} - {len(wrong_labels)} label(s)"
+                for row in wrong_labels.head(labels_to_report).itertuples():
+                    message += f"\n    {row.code} - '{row.label}' should be '{row.expected_label}' ({row.rows} rows)"
+                if len(wrong_labels) > labels_to_report:
+                    message += f"\n    and {len(wrong_labels) - labels_to_report} more"
+            raise Exception(message)
@@ -0,0 +1,119 @@
+# columnar (parquet) copy of a v4, written next to the csv as v4-<dataset>.parquet
+# dimension columns are dictionary encoded so each code & label is stored once
+# the csv is still what is uploaded to CMD, the sidecar is only used to read the v4 more
+# quickly and only if the csv has not changed since the sidecar was written
+import os
+import pandas as pd
+
+# pyarrow is optional, without it v4s are always read from the csv
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+def sidecar_path(v4_file):
+    return f"{os.path.splitext(v4_file)[0]}.parquet"
+
+def _csv_details(v4_file):
+    # size & modified time of the csv, stored in the sidecar to tell if it is stale
+    stat = os.stat(v4_file)
+    return {b"v4_csv_size": str(stat.st_size).encode(), b"v4_csv_mtime_ns": str(stat.st_mtime_ns).encode()}
+
+def write_v4_sidecar(v4_file, **kwargs):
+    """
+    Converts a v4 csv to a parquet sidecar, reading and writing a block at a time so the
+    v4 is never held in memory whole
+    Returns the sidecar path, None if pyarrow is not installed
+    block_size - bytes of csv read at once
+    """
+    if pa is None:
+        print(f"pyarrow is not installed, no parquet sidecar written for {v4_file}")
+        return None
+
+    if 'block_size' in kwargs.keys():
+        block_size = kwargs['block_size']
+    else:
+        block_size = 64 * 1024 * 1024
+
+    column_names = read_v4_header(v4_file)
+    v4_marker = int(column_names[0][-1])
+    # observation & data marking columns stay as strings, dimensions are dictionary encoded
+    column_types = {}
+    for position, column in enumerate(column_names):
+        if position > v4_marker:
+            column_types[column] = pa.dictionary(pa.int32(), pa.string())
+        else:
+            column_types[column] = pa.string()
+
+    reader = pa_csv.open_csv(
+        v4_file,
+        read_options=pa_csv.ReadOptions(block_size=block_size, column_names=column_names, skip_rows=1),
+        convert_options=pa_csv.ConvertOptions(column_types=column_types, strings_can_be_null=True)
+        )
+    schema = reader.schema.with_metadata(_csv_details(v4_file))
+
+    output_file = sidecar_path(v4_file)
+    temp_file = f"{output_file}.{os.getpid()}.part"
+    try:
+        with pq.ParquetWriter(temp_file, schema) as writer:
+            for batch in reader:
+                writer.write_batch(batch)
+    except:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    os.replace(temp_file, output_file)
+    print(f"written {output_file}")
+    return output_file
+
+def has_fresh_sidecar(v4_file):
+    # True if there is a sidecar written from the csv as it is now
+    if pa is None or not os.path.exists(sidecar_path(v4_file)):
+        return False
+    metadata = pq.read_schema(sidecar_path(v4_file)).metadata or {}
+    csv_details = _csv_details(v4_file)
+    return all(metadata.get(key) == csv_details[key] for key in csv_details)
+
+def read_v4_header(v4_file):
+    # column names as pandas would name them
+    return list(pd.read_csv(v4_file, dtype=str, nrows=0).columns)
+
+def read_v4(v4_file):
+    """
+    Returns the whole v4 as a DataFrame of strings, as pd.read_csv(v4_file, dtype=str) would
+    Read from the sidecar if there is a fresh one
+    """
+    if not has_fresh_sidecar(v4_file):
+        return pd.read_csv(v4_file, dtype=str)
+
+    table = pq.read_table(sidecar_path(v4_file))
+    table = table.cast(pa.schema([pa.field(field.name, pa.string()) for field in table.schema]))
+    df = table.to_pandas()
+    df.columns = read_v4_header(v4_file)
+    return df
+
+def iter_v4_chunks(v4_file, usecols, chunk_size):
+    """
+    Yields the v4 chunk_size rows at a time as DataFrames of categories
+    usecols - positions of the columns to read
+    Read from the sidecar if there is a fresh one, a chunk's categories may include
+    values that are not in that chunk
+    """
+    column_names = read_v4_header(v4_file)
+    usecols = sorted(usecols)
+
+    if not has_fresh_sidecar(v4_file):
+        yield from pd.read_csv(v4_file, dtype="category", usecols=usecols, chunksize=chunk_size)
+        return
+
+    parquet_file = pq.ParquetFile(sidecar_path(v4_file))
+    parquet_columns = [parquet_file.schema_arrow.names[position] for position in usecols]
+    for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=parquet_columns):
+        chunk = batch.to_pandas()
+        chunk.columns = [column_names[position] for position in usecols]
+        for column in chunk.columns:
+            if chunk[column].dtype != "category":
+                chunk[column] = chunk[column].astype("category")
+        yield chunk
@@ -0,0 +1,189 @@
+import os, struct, zlib, fnmatch, threading
+
+# zip signatures
+local_file_header = b"PK\x03\x04"
+central_directory_header = b"PK\x01\x02"
+end_of_central_directory = b"PK\x05\x06"
+data_descriptor = b"PK\x07\x08"
+
+class ZipStreamError(Exception):
+    """
+    Raised when a zip cannot be extracted from a stream, i.e. stored members of unknown
+    size, encrypted members or unsupported compression, the zip should be downloaded and
+    extracted with zipfile instead
+    """
+
+class _StreamReader:
+    """
+    Reads exact numbers of bytes from an iterator of chunks
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+
+    def read(self, size):
+        # returns up to size bytes, fewer only at the end of the stream
+        while len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def read_exact(self, size):
+        data = self.read(size)
+        if len(data) != size:
+            raise ZipStreamError("zip stream ended unexpectedly")
+        return data
+
+    def read_some(self):
+        # returns whatever is buffered or the next chunk
+        if self.buffer:
+            data, self.buffer = self.buffer, b""
+            return data
+        return next(self.chunks, b"")
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+
+def _safe_path(name):
+    # same rules as zipfile, strips drive letters, absolute paths and '..'
+    name = name.replace("\\", "/")
+    parts = [part for part in name.split("/") if part not in ("", ".", "..")]
+    parts = [part.split(":")[-1] for part in parts]
+    return "/".join(parts)
+
+def _zip64_sizes(extra, compressed_size, uncompressed_size):
+    # reads sizes from the zip64 extra field if the header sizes are maxed out
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, data_size = struct.unpack("<HH", extra[offset:offset + 4])
+        data = extra[offset + 4:offset + 4 + data_size]
+        if header_id == 0x0001:
+            values = [struct.unpack("<Q", data[i:i + 8])[0] for i in range(0, len(data) - 7, 8)]
+            if uncompressed_size == 0xFFFFFFFF and values:
+                uncompressed_size = values.pop(0)
+            if compressed_size == 0xFFFFFFFF and values:
+                compressed_size = values.pop(0)
+            return compressed_size, uncompressed_size, True
+        offset += 4 + data_size
+    return compressed_size, uncompressed_size, False
+
+def extract_zip_stream(chunks, **kwargs):
+    """
+    Extracts a zip from an iterator of byte chunks (i.e. a download) as it arrives, the
+    archive itself is never written to disk
+    members - list of glob patterns, only matching members are extracted, all if not given
+    location - directory to extract into, current directory if not given
+    first_only - only the first matching member is extracted, the rest of the stream is not read
+    Returns list of extracted files in archive order
+    """
+    if 'members' in kwargs.keys() and kwargs['members']:
+        members = kwargs['members']
+    else:
+        members = ["*"]
+
+    if 'first_only' in kwargs.keys():
+        first_only = kwargs['first_only']
+    else:
+        first_only = False
+
+    if 'location' in kwargs.keys():
+        location = kwargs['location']
+    else:
+        location = ""
+
+    stream = _StreamReader(chunks)
+    extracted_files = []
+
+    while True:
+        signature = stream.read(4)
+        if signature in (central_directory_header, end_of_central_directory, b""):
+            # all members have been read
+            break
+        if signature != local_file_header:
+            raise ZipStreamError(f"unexpected zip signature {signature}")
+
+        (version, flags, method, mod_time, mod_date, crc, compressed_size,
+            uncompressed_size, name_length, extra_length) = struct.unpack("<HHHHHIIIHH", stream.read_exact(26))
+        raw_name = stream.read_exact(name_length)
+        extra = stream.read_exact(extra_length)
+        name = raw_name.decode("utf-8") if flags & 0x800 else raw_name.decode("cp437")
+        compressed_size, uncompressed_size, zip64 = _zip64_sizes(extra, compressed_size, uncompressed_size)
+
+        has_descriptor = bool(flags & 0x08)
+        if flags & 0x01:
+            raise ZipStreamError(f"{name} is encrypted")
+        if method not in (0, 8):
+            raise ZipStreamError(f"{name} uses unsupported compression method {method}")
+        if method == 0 and has_descriptor:
+            raise ZipStreamError(f"{name} is stored with an unknown size")
+
+        path = _safe_path(name)
+        wanted = bool(path) and not name.endswith("/") and any(fnmatch.fnmatch(path, pattern) for pattern in members)
+
+        output = None
+        if wanted:
+            output_file = os.path.join(location, path) if location else path
+            if os.path.dirname(output_file):
+                os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            temp_file = f"{output_file}.{threading.get_ident()}.part"
+            output = open(temp_file, "wb")
+
+        try:
+            actual_crc = 0
+            if method == 0:
+                remaining = compressed_size
+                while remaining:
+                    data = stream.read(min(remaining, 1024 * 1024))
+                    if not data:
+                        raise ZipStreamError("zip stream ended unexpectedly")
+                    remaining -= len(data)
+                    if output:
+                        actual_crc = zlib.crc32(data, actual_crc)
+                        output.write(data)
+
+            else:
+                decompressor = zlib.decompressobj(-15)
+                remaining = None if has_descriptor else compressed_size
+                while not decompressor.eof:
+                    if remaining is None:
+                        data = stream.read_some()
+                    else:
+                        data = stream.read(min(remaining, 1024 * 1024))
+                        remaining -= len(data)
+                    if not data:
+                        raise ZipStreamError("zip stream ended unexpectedly")
+                    # always decompressed, it is how the end of a member is found
+                    decompressed = decompressor.decompress(data)
+                    if output:
+                        actual_crc = zlib.crc32(decompressed, actual_crc)
+                        output.write(decompressed)
+                stream.unread(decompressor.unused_data)
+
+            if has_descriptor:
+                descriptor = stream.read_exact(4)
+                if descriptor == data_descriptor:
+                    descriptor = stream.read_exact(4)
+                crc = struct.unpack("<I", descriptor)[0]
+                stream.read_exact(16 if zip64 else 8) # sizes
+
+        except:
+            if output:
+                output.close()
+                os.remove(temp_file)
+            raise
+
+        if output:
+            output.close()
+            if actual_crc != crc:
+                os.remove(temp_file)
+                raise ZipStreamError(f"{name} failed its crc check")
+            os.replace(temp_file, output_file)
+            extracted_files.append(output_file)
+            print(f"extracted {output_file}")
+            if first_only:
+                break
+
+    return extracted_files
@@ -4,47 +4,61 @@ from pathlib import Path
 sys.path.append(f"{Path(__file__).parent.as_posix()}/clients")
 
 from clients.ashe_client import AsheSourceData, AsheTransform, AsheCombiner, ashe_number_lookup, provisional_or_revised_lookup, time_series_ashe_tables, list_of_ashe_tables
-from clients.transform_client import Transform, TransformLocal, list_of_transforms
-from clients.source_data_client import SourceData
+from clients.transform_client import list_of_transforms
 from clients.upload_details_client import UploadDetails
 from clients.upload_to_cmd_client import UploadToCmd
 from clients.v4_checker_client import V4Checker
 from clients.clear_repo import ClearRepo
+from clients.pipeline_client import Pipeline, pipeline_stages
 from clients.send_email_client import EmailSender
+from clients.v4_sidecar import write_v4_sidecar
 
 description = f'''Transform and upload program - transforms available as of 15/02/23:
 {list_of_transforms}
 {list_of_ashe_tables}
 '''
 
-parser = argparse.ArgumentParser(description=description)
-parser.add_argument("-d", "--datasets", help="Datasets to be transformed", nargs="*", required=True)
-parser.add_argument("-u", "--upload", help="Include if upload should be run", action="store_true")
-parser.add_argument("-up", "--upload_partial", help="Include if partial upload should be run", action="store_true")
-parser.add_argument("-rl", "--run_locally", help="Include if transform should be run from local script", action="store_true")
-parser.add_argument("-s", "--source_files", help="Include if giving source files directly", nargs="*")
-parser.add_argument("-C", "--clear_repo", help="Include to clear up repo after upload run", action="store_true")
-parser.add_argument("-I", "--ignore_release_date", help="Include to ignore release date when downloading source files", action="store_true")
-
-args = parser.parse_args()
-
-datasets = args.datasets
-upload = args.upload
-upload_partial = args.upload_partial
-run_locally = args.run_locally # to run local script - used when changes are needed to a transform and want to be tested
-source_files = args.source_files # pass source file(s) path if source data is not from ons site    
-clear_repo = args.clear_repo # clears repo of source files and v4s after upload
-ignore_release_date = args.ignore_release_date # ignores release date of source files
-
-if upload and upload_partial:
-    raise Exception("Cannot run with both '-u' & '-up' flags") 
-if upload_partial:
-    upload = 'partial'
-
-# running the transform
-transform_output = {}
-for dataset in datasets:
-    if dataset == 'ashe':
+def main():
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("-d", "--datasets", help="Datasets to be transformed", nargs="*", required=True)
+    parser.add_argument("-u", "--upload", help="Include if upload should be run", action="store_true")
+    parser.add_argument("-up", "--upload_partial", help="Include if partial upload should be run", action="store_true")
+    parser.add_argument("-rl", "--run_locally", help="Include if transform should be run from local script", action="store_true")
+    parser.add_argument("-s", "--source_files", help="Include if giving source files directly", nargs="*")
+    parser.add_argument("-C", "--clear_repo", help="Include to clear up repo after upload run", action="store_true")
+    parser.add_argument("-I", "--ignore_release_date", help="Include to ignore release date when downloading source files", action="store_true")
+    parser.add_argument("-W", "--watch_release", help="Include to wait for the source files to be released before downloading them", action="store_true")
+    parser.add_argument("-O", "--offline", help="Include to run transforms and validation from the local cache without fetching transforms or code lists", action="store_true")
+    parser.add_argument("-NL", "--skip_label_check", help="Include to skip checking v4 labels against the code lists", action="store_true")
+    parser.add_argument("-pq", "--parquet", help="Include to write a parquet copy of each v4, used to validate it more quickly (needs pyarrow)", action="store_true")
+    parser.add_argument("-sw", "--stage_workers", help=f"Number of datasets allowed in a stage at once, as stage=number - stages are {pipeline_stages}", nargs="*")
+
+    args = parser.parse_args()
+
+    datasets = args.datasets
+    upload = args.upload
+    upload_partial = args.upload_partial
+    run_locally = args.run_locally # to run local script - used when changes are needed to a transform and want to be tested
+    source_files = args.source_files # pass source file(s) path if source data is not from ons site    
+    clear_repo = args.clear_repo # clears repo of source files and v4s after upload
+    ignore_release_date = args.ignore_release_date # ignores release date of source files
+    watch_release = args.watch_release # polls landing pages until the release goes live
+    offline = args.offline # uses cached transform scripts & code lists
+    skip_label_check = args.skip_label_check # labels are not checked when validating
+    parquet = args.parquet # writes parquet sidecars of the v4s
+    stage_workers = dict(item.split("=") for item in args.stage_workers) if args.stage_workers else {} # concurrency of each pipeline stage
+
+    if upload and upload_partial:
+        raise Exception("Cannot run with both '-u' & '-up' flags") 
+    if upload_partial:
+        upload = 'partial'
+    if watch_release and ignore_release_date:
+        raise Exception("Cannot run with both '-W' & '-I' flags")
+
+    # running the transform
+    # ashe runs on its own as it needs user input, every other dataset runs through the pipeline
+    transform_output = {}
+    if 'ashe' in datasets:
         # separate transform process for ashe datasets 
         table_number = str(input("Ashe table number to run (Only one table number required): "))
         if table_number not in ashe_number_lookup.keys():
@@ -65,68 +79,65 @@ for dataset in datasets:
         source_data.get_source_files()
         print(source_data.downloaded_files)
 
-        transform = AsheTransform(table_number, year_of_data=year_of_data)
+        transform = AsheTransform(table_number, year_of_data=year_of_data, offline=offline)
 
         if run_locally:
             transform.run_transform_local()
         else:
             transform.run_transform()
-        
+
         transform_output.update(transform.transform_output)
+        if parquet:
+            for v4_file in transform.transform_output.values():
+                write_v4_sidecar(v4_file)
 
         # combiner = AsheCombiner(table_number, transform_output[table_number])
-    
-    else:
-        if not source_files: # source files need downloading
-            print(f"downloading source files for {dataset}")
-            source = SourceData(dataset, ignore_release_date=ignore_release_date)
-            source_files = source.get_source_files()
-
-        if run_locally:
-            print("running transform locally")
-            transform = TransformLocal(dataset, source_files=source_files)
-            transform.run_transform()
-
-        else:
-            transform = Transform(dataset, source_files=source_files)
-            transform.run_transform()
-            
-    source_files = None # wipe previous source files
-    transform_output.update(transform.transform_output)
-
-# uploading data
-if upload == True:
-    # validate v4s
-    validate_object = V4Checker(transform_output)
-    validate_object.run_check()
-
-    # creating upload_dict
-    if dataset == 'ashe':
-        upload_dict = UploadDetails(transform_output, edition=edition).create()
-    else:
-        upload_dict = UploadDetails(transform_output).create()
-
-    upload = UploadToCmd(upload_dict)
-    upload.run_upload()
-
-    email = EmailSender(upload_dict)
-    email.send()
-
-elif upload == 'partial':
-    # validate v4s
-    validate_object = V4Checker(transform_output)
-    validate_object.run_check()
-
-    # creating upload_dict
-    print('running partial upload')
-    if dataset == 'ashe':
-        upload_dict = UploadDetails(transform_output, edition=edition).create()
-    else:
-        upload_dict = UploadDetails(transform_output).create()
-
-    upload = UploadToCmd(upload_dict)
-    upload.run_partial_upload()
-
-if clear_repo:
-    ClearRepo()
 
+        # uploading data
+        if upload:
+            # validate v4s
+            validate_object = V4Checker(transform_output, offline=offline, check_labels=not skip_label_check)
+            validate_object.run_check()
+
+            # creating upload_dict
+            upload_dict = UploadDetails(transform_output, edition=edition).create()
+            upload_object = UploadToCmd(upload_dict)
+
+            if upload == True:
+                upload_object.run_upload()
+
+                email = EmailSender(upload_dict)
+                email.send()
+
+            elif upload == 'partial':
+                print('running partial upload')
+                upload_object.run_partial_upload()
+
+    datasets = [dataset for dataset in datasets if dataset != 'ashe']
+    if datasets:
+        # source files passed with -s are used for the first dataset only
+        if source_files:
+            source_files = {datasets[0]: source_files}
+
+        pipeline = Pipeline(
+            datasets, upload=upload, run_locally=run_locally, ignore_release_date=ignore_release_date, 
+            source_files=source_files, stage_workers=stage_workers, offline=offline, watch_release=watch_release,
+            check_labels=not skip_label_check, sidecar=parquet
+            )
+        try:
+            pipeline.run()
+        finally:
+            # datasets finish independently, the ones that were added to collections are
+            # emailed about even if another dataset failed
+            if upload == True and pipeline.upload_dict:
+                email = EmailSender(pipeline.upload_dict)
+                email.send()
+        transform_output.update(pipeline.transform_output)
+
+    if clear_repo:
+        ClearRepo()
+
+
+if __name__ == "__main__":
+    # guard is needed as transforms run in spawned worker processes which import this file
+    main()
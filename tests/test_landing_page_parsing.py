@@ -0,0 +1,25 @@
+import os, sys, glob
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+
+from landing_page_parsing import fixtures_dir, split_parse, targeted_parse
+
+fixtures = sorted(glob.glob(os.path.join(fixtures_dir, "*.html")))
+
+@pytest.mark.skipif(not fixtures, reason="no landing pages saved, run python benchmarks/landing_page_parsing.py --save-fixtures")
+@pytest.mark.parametrize("fixture", fixtures, ids=os.path.basename)
+def test_parsers_agree(fixture):
+    # _parse_landing_page must give the release date & links the old split based parsing gave
+    with open(fixture, "rb") as f:
+        content = f.read()
+    old = split_parse(content)
+    assert old['release_date'] and old['links']
+    assert targeted_parse(content) == old
+
+@pytest.mark.skipif(not glob.glob(os.path.join(fixtures_dir, "weekly-deaths-*.html")), reason="no weekly deaths landing page saved")
+def test_weekly_deaths_has_two_editions():
+    # weekly deaths downloads the latest two editions
+    for fixture in glob.glob(os.path.join(fixtures_dir, "weekly-deaths-*.html")):
+        with open(fixture, "rb") as f:
+            assert len(targeted_parse(f.read())['links']) >= 2
@@ -0,0 +1,96 @@
+import io, os, sys, zipfile
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "clients"))
+
+from zip_stream import extract_zip_stream, ZipStreamError
+
+class Unseekable(io.RawIOBase):
+    # zipfile writes a data descriptor after each member when it cannot seek back
+    def __init__(self):
+        self.buffer = io.BytesIO()
+    def writable(self):
+        return True
+    def write(self, data):
+        return self.buffer.write(data)
+
+files = {
+    "data.csv": b"dimension,value\n" + b"a,1\nb,2\n" * 5000,
+    "sub/readme.txt": b"not needed",
+    "notes.xlsx": os.urandom(20000),
+    }
+
+def make_zip(compression, **kwargs):
+    # returns the zip as bytes, data_descriptor & zip64 set how members are written
+    output = Unseekable() if kwargs.get('data_descriptor') else io.BytesIO()
+    with zipfile.ZipFile(output, "w", compression=compression) as zip_file:
+        for name, content in files.items():
+            with zip_file.open(name, "w", force_zip64=kwargs.get('zip64', False)) as member:
+                member.write(content)
+    return output.buffer.getvalue() if kwargs.get('data_descriptor') else output.getvalue()
+
+def chunks(data, size=7):
+    # small chunks so headers & members are split across chunks
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+def check_extracted(extracted_files, location, names):
+    assert extracted_files == [os.path.join(location, name) for name in names]
+    for name in names:
+        with open(os.path.join(location, name), "rb") as f:
+            assert f.read() == files[name]
+    assert not [file for root, dirs, found in os.walk(location) for file in found if file.endswith(".part")]
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED])
+@pytest.mark.parametrize("zip64", [False, True])
+def test_extracts_every_member(tmp_path, compression, zip64):
+    data = make_zip(compression, zip64=zip64)
+    extracted_files = extract_zip_stream(chunks(data), location=str(tmp_path))
+    check_extracted(extracted_files, str(tmp_path), list(files))
+
+@pytest.mark.parametrize("zip64", [False, True])
+def test_data_descriptor_members(tmp_path, zip64):
+    data = make_zip(zipfile.ZIP_DEFLATED, data_descriptor=True, zip64=zip64)
+    assert zipfile.ZipFile(io.BytesIO(data)).infolist()[0].flag_bits & 0x08
+    extracted_files = extract_zip_stream(chunks(data, 1000), location=str(tmp_path))
+    check_extracted(extracted_files, str(tmp_path), list(files))
+
+def test_stored_data_descriptor_members_are_not_streamed(tmp_path):
+    data = make_zip(zipfile.ZIP_STORED, data_descriptor=True)
+    with pytest.raises(ZipStreamError):
+        extract_zip_stream(chunks(data), location=str(tmp_path))
+
+def test_member_filtering(tmp_path):
+    data = make_zip(zipfile.ZIP_DEFLATED)
+    extracted_files = extract_zip_stream(chunks(data), location=str(tmp_path), members=["*.csv", "*.xlsx"])
+    check_extracted(extracted_files, str(tmp_path), ["data.csv", "notes.xlsx"])
+    assert not os.path.exists(tmp_path / "sub")
+
+def test_first_only_stops_reading(tmp_path):
+    data = make_zip(zipfile.ZIP_DEFLATED)
+    read = []
+    def tracked_chunks():
+        for chunk in chunks(data, 1000):
+            read.append(chunk)
+            yield chunk
+    extracted_files = extract_zip_stream(tracked_chunks(), location=str(tmp_path), first_only=True)
+    check_extracted(extracted_files, str(tmp_path), ["data.csv"])
+    assert sum(len(chunk) for chunk in read) < len(data)
+
+def test_crc_failure(tmp_path):
+    data = bytearray(make_zip(zipfile.ZIP_STORED))
+    # flips a byte of the first member's content
+    position = data.index(files["data.csv"][:20]) + 5
+    data[position] ^= 0xFF
+    with pytest.raises(ZipStreamError):
+        extract_zip_stream(chunks(bytes(data)), location=str(tmp_path))
+    assert os.listdir(tmp_path) == []
+
+def test_unsafe_paths_stay_in_location(tmp_path):
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, "w") as zip_file:
+        zip_file.writestr("../../outside.txt", b"x")
+        zip_file.writestr("/absolute.txt", b"y")
+    location = tmp_path / "out"
+    extracted_files = extract_zip_stream(chunks(output.getvalue()), location=str(location))
+    assert extracted_files == [os.path.join(str(location), "outside.txt"), os.path.join(str(location), "absolute.txt")]
+    assert sorted(os.listdir(tmp_path)) == ["out"]